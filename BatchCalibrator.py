@@ -0,0 +1,82 @@
+from MonoCalibrator import *
+from calib_logger import CalibLogger
+from params import Params
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import json
+import os
+
+
+class BatchCalibrator(Params):
+    """
+    Headless calibration of recorded sessions, without a camera attached.
+    Every input is either a tar archive written by MonoCalibrator.do_tarfile_save, a sample spool directory or a directory of images,
+    and gives one ost.yaml and one json result in its own directory under --batch_output.
+    """
+    
+    def __init__(self):
+        
+        Params.__init__(self)
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self.boards = [ChessboardInfo(self.args.chessboard_w,self.args.chessboard_h,self.args.chessboard_sqr_size)]
+        self.camera_model = CAMERA_MODEL.FISHEYE if self.args.camera_model == "fisheye" else CAMERA_MODEL.PINHOLE
+        
+    @staticmethod
+    def session_name(path):
+        name = os.path.basename(os.path.normpath(path))
+        for ext in (".tar.gz",".tgz",".tar"):
+            if name.endswith(ext):
+                return name[:-len(ext)]
+        return name
+        
+    def calibrate_session(self,path,pool):
+        """
+        Calibrate a single archive or image directory and write its results.
+        """
+        mc = MonoCalibrator(self.boards,checkerboard_flags = cv2.CALIB_CB_FAST_CHECK)
+        mc.set_cammodel(self.camera_model)
+        
+        if os.path.isfile(os.path.join(path,SpoolSampleStore.INFO_FILE)):
+            mc.do_spool_calibration(path,pool)
+        elif os.path.isdir(path):
+            mc.do_directory_calibration(path,pool)
+        else:
+            mc.do_tarfile_calibration(path,pool)
+            
+        name = self.session_name(path)
+        out_dir = os.path.join(self.args.batch_output,name)
+        os.makedirs(out_dir,exist_ok = True)
+        
+        with open(os.path.join(out_dir,"ost.yaml"),"w") as f:
+            f.write(mc.yaml())
+        with open(os.path.join(out_dir,"calibration.json"),"w") as f:
+            json.dump({name : mc.as_dict()},f,indent = 4)
+            
+        self.logger.info(f"============ {name} : calibrated from {len(mc.good_corners)} images , results in {out_dir} ============")
+        
+    def run(self):
+        if not self.args.batch_input:
+            self.logger.error("Nothing to calibrate, give the archives or image directories with --batch_input")
+            return
+        
+        workers = self.args.batch_workers if self.args.batch_workers > 0 else os.cpu_count()
+        failed = []
+        
+        # one pool for all the sessions, so that the workers are only started once
+        with ProcessPoolExecutor(max_workers = workers,
+                                 mp_context = multiprocessing.get_context("spawn"),
+                                 initializer = init_detection_worker) as pool:
+            for path in self.args.batch_input:
+                start = time.time()
+                try:
+                    self.calibrate_session(path,pool)
+                except (CalibrationException,cv2.error,OSError,tarfile.TarError) as e:
+                    self.logger.error(f"============ {path} : calibration failed : {e} ============")
+                    failed.append(path)
+                    continue
+                self.logger.info(f"{path} took {time.time() - start:.2f} s")
+                
+        self.logger.info(f"============ Batch done : {len(self.args.batch_input) - len(failed)} calibrated , {len(failed)} failed ============")
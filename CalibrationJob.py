@@ -0,0 +1,116 @@
+from utils import *
+from calib_logger import CalibLogger
+
+import uuid
+
+
+class CalibrationJob():
+    """
+    Calibration running in a background thread, so that the request starting it returns at once and the
+    capture and the preview keep running. The solver releases the GIL, the other threads are not stalled.
+    
+    target(job) does the work and reports its progress with job.step(fraction,stage), which raises
+    CalibrationCancelled once the job is cancelled or past its timeout : cancellation takes effect at the
+    next step, a solve in progress is not interrupted but its result is discarded.
+    
+    status is queued, running, cancelling, done, failed, cancelled or timeout.
+    """
+    
+    def __init__(self,target,timeout = 0):
+        self.id = uuid.uuid4().hex[:12]
+        self.timeout = timeout
+        self.stage = None
+        self.progress = 0.0
+        self.message = None
+        self.started = None
+        self.ended = None
+        # on_update(job) is called on every step and when the job ends
+        self.on_update = None
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self._target = target
+        self._status = "queued"
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._deadline = None
+        
+    @property
+    def status(self):
+        if self._status == "running" and self._cancel.is_set():
+            return "cancelling"
+        return self._status
+    
+    @property
+    def finished(self):
+        return self._done.is_set()
+    
+    def start(self):
+        th = threading.Thread(target = self._run,name = "calibration-%s" % self.id)
+        th.daemon = True
+        th.start()
+        
+    def _run(self):
+        self.started = time.time()
+        if self.timeout > 0:
+            self._deadline = time.perf_counter() + self.timeout
+        self._status = "running"
+        self.notify()
+        try:
+            self._target(self)
+            self.progress = 1.0
+            self._status = "done"
+        except CalibrationCancelled as e:
+            self.message = str(e)
+            self._status = "cancelled" if self._cancel.is_set() else "timeout"
+        except Exception as e:
+            self.logger.exception("Calibration job %s failed" % self.id)
+            self.message = str(e)
+            self._status = "failed"
+        finally:
+            self.ended = time.time()
+            self._done.set()
+            self.logger.info("########## calibration job %s : %s in %.2f s ##########" % (self.id,self._status,self.ended - self.started))
+            self.notify()
+            
+    def step(self,progress,stage = None):
+        """
+        Report the progress (0 to 1) of the job, raises CalibrationCancelled if it should stop.
+        """
+        self.progress = round(float(progress),3)
+        if stage is not None:
+            self.stage = stage
+        self.notify()
+        if self._cancel.is_set():
+            raise CalibrationCancelled("Cancelled")
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise CalibrationCancelled("Timed out after %g s" % self.timeout)
+        
+    def notify(self):
+        if self.on_update is not None:
+            self.on_update(self)
+            
+    def cancel(self):
+        """
+        Ask the job to stop. Returns False if it has already ended.
+        """
+        if self.finished:
+            return False
+        self._cancel.set()
+        self.notify()
+        return True
+    
+    def wait(self,timeout = None):
+        return self._done.wait(timeout)
+    
+    def as_dict(self):
+        return {
+            "id" : self.id,
+            "status" : self.status,
+            "stage" : self.stage,
+            "progress" : self.progress,
+            "message" : self.message,
+            "started" : self.started,
+            "ended" : self.ended,
+            "timeout" : self.timeout
+        }
@@ -1,11 +1,19 @@
 from utils import *
 from MonoCalibrator import *
 from calib_logger import CalibLogger
+from metrics import METRICS
+from CameraCapture import CameraCapture
+from CalibrationJob import CalibrationJob
 
+from concurrent.futures import ProcessPoolExecutor , CancelledError
+import multiprocessing
 import os
 
 
 class CalibrationNode():
+    # seconds release() waits for each consumer thread
+    RELEASE_TIMEOUT = 5.0
+    
     def __init__(self,
                  boards,
                  flags = 0,
@@ -15,7 +23,13 @@ class CalibrationNode():
                  queue_size = 1,
                  cam_index = None,
                  img_w = 640,
-                 img_h = 480):
+                 img_h = 480,
+                 detection_workers = 0,
+                 fourcc = "MJPG",
+                 fps = 30,
+                 capture_buffers = 2,
+                 source = None,
+                 camera = None):
         
         self._boards = boards
         self._calib_flags = flags 
@@ -25,50 +39,246 @@ class CalibrationNode():
         self._cam_index = cam_index
         self._img_w = img_w
         self._img_h = img_h
+        self._fourcc = fourcc
+        self._fps = fps
+        self._capture_buffers = capture_buffers
+        # recorded frames (FrameSource) replayed instead of the camera
+        self._source = source
+        # camera label of the metrics of the session, e.g. the serial number
+        self._camera = camera
+        
+        # end-to-end throughput : frames handled by the calibrator since the first one
+        self.frames_handled = 0
+        self._first_frame = None
+        self._last_frame = None
+        
+        self.logger = CalibLogger().get_logger()
         
-        self.q_mono = BufferQueue(queue_size)
+        self.q_mono = BufferQueue(queue_size,name = "calibrator",camera = camera)
         
         self.c = None 
         self.cap = None
+        self._c_lock = threading.Lock()
         
         self._last_display = None
         
+        # state of the session (progress, sample count, linear error) for the web page
+        self.progress = ProgressChannel()
+        # CalibrationJob of the last calibration
+        self.job = None
+        # live preview solve running in the background, and the sample count of the last one
+        self._estimate_thread = None
+        self._estimate_samples = 0
+        
         cam_cap_th = threading.Thread(target = self.queue_monocular)
         cam_cap_th.daemon = True
         cam_cap_th.start()
         
-        mth = ConsumerThread(self.q_mono,self.handle_monocular)
+        self.detection_pool = None
+        if detection_workers > 0:
+            # Checkerboard detection runs in worker processes. Frames are dispatched in capture order and
+            # their detections are handed to the calibrator in the same order through q_detect.
+            self.detection_pool = ProcessPoolExecutor(max_workers = detection_workers,
+                                                      mp_context = multiprocessing.get_context("spawn"),
+                                                      initializer = init_detection_worker)
+            # When every worker is busy the dispatcher blocks here, and q_mono drops the stale frames instead.
+            self.q_detect = Queue(maxsize = 2 * detection_workers)
+            
+            dth = ConsumerThread(self.q_mono,self.dispatch_monocular,camera)
+            dth.daemon = True
+            dth.start()
+            
+            mth = ConsumerThread(self.q_detect,self.handle_detected,camera)
+        else:
+            dth = None
+            mth = ConsumerThread(self.q_mono,self.handle_monocular,camera)
         mth.daemon = True
         mth.start()
+        # stopped by release(), upstream one first
+        self._consumers = [th for th in (dth,mth) if th is not None]
         
     def redraw_monocular(self,*args):
         pass
     
-    # need to modify this function to fetch image from camer capture class
     def queue_monocular(self):
-        self.cap = cv2.VideoCapture(self._cam_index)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH,self._img_w)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT,self._img_h)
+        METRICS.bind_camera(self._camera)
+        if self._source is not None:
+            self.cap = self._source
+            # replaying as fast as possible must not drop frames to be reproducible
+            self.cap.run(self.q_mono.put_wait if self._source.is_lossless else self.q_mono.put)
+            return
+        self.cap = CameraCapture(self._cam_index,self._img_w,self._img_h,self._fourcc,self._fps,self._capture_buffers,self._camera)
+        self.cap.run(self.q_mono.put)
+        
+    def stats(self):
+        """
+        Capture statistics of the camera, frames discarded because the calibrator could not keep up, and the
+        savings of the ROI tracking and of the frame gate.
+        """
+        stats = self.cap.stats() if self.cap is not None else {}
+        stats["calibrator_dropped_frames"] = self.q_mono.dropped
+        stats["frames_handled"] = self.frames_handled
+        if self.frames_handled > 1 and self._last_frame > self._first_frame:
+            stats["end_to_end_fps"] = round((self.frames_handled - 1) / (self._last_frame - self._first_frame),2)
+        stats["samples_accepted"] = len(self.c.db) if self.c is not None else 0
+        if self.c is not None:
+            stats.update(self.c.detection_stats())
+        return stats
         
-        while self.cap.isOpened():
-            ret,frame = self.cap.read()
-            if ret:
-                self.q_mono.put(frame)
+    def drain(self):
+        """
+        Wait until the frame source has ended and the calibrator has handled all its frames, e.g. at the end
+        of a replay.
+        """
+        while self.cap is None:
+            time.sleep(0.01)
+        if self._source is not None:
+            self._source.done.wait()
+        self.q_mono.join()
+        if self.detection_pool is not None:
+            self.q_detect.join()
         
     def release(self):
-        self.cap.release()
+        if self.job is not None:
+            self.job.cancel()
+        self.progress.close()
+        if self.cap is not None:
+            self.cap.release()
+        for (i,th) in enumerate(self._consumers):
+            th.stop()
+            if i == 0 and self.detection_pool is not None:
+                # detections still in flight are cancelled, the merging consumer drops them
+                self.detection_pool.shutdown(wait = False,cancel_futures = True)
+            th.join(self.RELEASE_TIMEOUT)
+            if th.is_alive():
+                self.logger.warning("Consumer thread %s still busy after %g s" % (th.name,self.RELEASE_TIMEOUT))
+            
+    def get_calibrator(self):
+        # created lazily by whichever consumer sees the first frame
+        with self._c_lock:
+            if self.c == None:
+                self.c = MonoCalibrator(self._boards,
+                                        self._calib_flags,
+                                        self._fisheye_calib_flags,
+                                        self._checkerboard_flags,
+                                        self._max_chessboard_speed)
+        return self.c
         
-    def handle_monocular(self,msg):
-        if self.c == None:
-            self.c = MonoCalibrator(self._boards,
-                                    self._calib_flags,
-                                    self._fisheye_calib_flags,
-                                    self._checkerboard_flags,
-                                    self._max_chessboard_speed)
+    def handle_monocular(self,msg,detection = None):
+        c = self.get_calibrator()
         # This should just call the MonoCalibrator
-        drawable = self.c.handle_msg(msg)
+        drawable = c.handle_msg(msg,detection)
+        self._last_frame = time.perf_counter()
+        if self._first_frame is None:
+            self._first_frame = self._last_frame
+        self.frames_handled += 1
         self.displaywidth = drawable.scrib.shape[1]
-        self.redraw_monocular(drawable)
+        with METRICS.timer("redraw"):
+            self.redraw_monocular(drawable)
+        self.publish_progress(drawable.linear_error)
+        if c.params.args.live_preview_every > 0:
+            self.update_estimate(c)
+            
+    def update_estimate(self,c):
+        """
+        Start a live preview solve when --live_preview_every new samples have been collected since the last one.
+        """
+        n = len(c.good_corners)
+        if c.calibrated or n < max(self._estimate_samples + c.params.args.live_preview_every,c.MIN_VIEWS):
+            return
+        
+        def solve(good):
+            METRICS.bind_camera(self._camera)
+            c.update_estimate(good)
+            self.publish_progress()
+            
+        # never alongside the calibration job, which waits for a preview solve in progress
+        with self._c_lock:
+            if (self._estimate_thread is not None and self._estimate_thread.is_alive()) or (self.job is not None and not self.job.finished):
+                return
+            self._estimate_samples = n
+            self._estimate_thread = threading.Thread(target = solve,args = (list(c.good_corners),),name = "live-preview")
+            self._estimate_thread.daemon = True
+            self._estimate_thread.start()
+        
+    def publish_progress(self,linear_error = -1,state = None):
+        """
+        Publish the state of the session : collecting samples, ready to calibrate, calibrating or calibrated,
+        the coverage of every calibration parameter with its histogram, the sample count, the linear error of the last frame and
+        the calibration job.
+        """
+        c = self.c
+        job = self.job
+        if state is None:
+            if job is not None and not job.finished:
+                state = "calibrating"
+            else:
+                state = "calibrated" if c.calibrated else ("ready" if c.goodenough else "collecting")
+        # sample count per bin of every parameter, None when --coverage_bins is 0
+        coverage = dict(c.coverage() or [])
+        progress = []
+        for (label,lo,hi,p) in (c.compute_goodenough() or []):
+            progress.append({"label" : label,"min" : round(float(lo),3),"max" : round(float(hi),3),"progress" : round(float(p),3),
+                             "coverage" : coverage.get(label)})
+        self.progress.publish({
+            "state" : state,
+            "samples" : len(c.db),
+            "progress" : progress,
+            "linear_error" : round(float(linear_error),2) if linear_error is not None and linear_error >= 0 else None,
+            "job" : job.as_dict() if job is not None else None,
+            "estimate" : self.estimate_dict(c.estimate)
+        })
+        
+    @staticmethod
+    def estimate_dict(estimate):
+        if estimate is None:
+            return None
+        K = estimate["intrinsics"]
+        return {
+            "samples" : estimate["samples"],
+            "fx" : round(float(K[0,0]),1),
+            "fy" : round(float(K[1,1]),1),
+            "cx" : round(float(K[0,2]),1),
+            "cy" : round(float(K[1,2]),1),
+            "reproj_err" : round(estimate["reproj_err"],3),
+            "change" : round(estimate["change"],4) if estimate["change"] is not None else None,
+            "converged" : estimate["converged"]
+        }
+        
+    def dispatch_monocular(self,msg):
+        """
+        Send the frame to the detection workers, keeping it in capture order.
+        """
+        c = self.get_calibrator()
+        gray = c.mkgray(msg)
+        reason = c.gate_frame(gray)
+        if reason is not None:
+            # nothing to detect, the consumer fills in the detection in order
+            self.q_detect.put((gray,reason))
+            return
+        try:
+            # corners tracked from the last merged detection, a few frames older than this one
+            future = self.detection_pool.submit(downsample_and_track,gray,c._boards,c.checkerboard_flags,c.tracked_corners(),c.detect_area)
+        except RuntimeError:
+            # pool has been shut down by release()
+            return
+        self.q_detect.put((gray,future))
+        
+    def handle_detected(self,item):
+        """
+        Merge the detection of the oldest frame in flight back into the sample database.
+        """
+        (gray,future) = item
+        if isinstance(future,str):
+            # skipped by the frame gate
+            self.handle_monocular(gray,self.c.gated_detection(gray,future))
+            return
+        try:
+            (detection,roi_hit,detect_time) = future.result()
+        except CancelledError:
+            return
+        self.c.record_detection(detection,roi_hit,detect_time)
+        self.handle_monocular(gray,detection)
         
         
 class OpenCVCalibrationNode(CalibrationNode):
@@ -79,11 +289,15 @@ class OpenCVCalibrationNode(CalibrationNode):
     FONT_SCALE = 0.6
     FONT_THICKNESS = 2
     
-    def __init__(self,*args,**kwargs):
+    def __init__(self,*args,overlay = True,**kwargs):
+        
+        # with overlay False the display carries only the camera image, the progress and the buttons being
+        # shown by the client from self.progress
+        self.overlay = overlay
+        self.queue_display = BufferQueue(maxsize = 1,name = "display",camera = kwargs.get("camera"))
         
         CalibrationNode.__init__(self,*args,**kwargs)
         
-        self.queue_display = BufferQueue(maxsize = 1)
         # self.initWindow()
         self.image = None
         
@@ -124,12 +338,37 @@ class OpenCVCalibrationNode(CalibrationNode):
     
     def on_mouse(self,x,y):
         if self.CALIBRATE_BUTTON_X_MIN <= x <= self.CALIBRATE_BUTTON_X_MAX and self.CALIBRATE_BUTTON_Y_MIN <= y <= self.CALIBRATE_BUTTON_Y_MAX:
-            if self.c.goodenough:
-                self.logger.info("########## CALIBRATING ##########")
-                self.c.do_calibration()
-                self.buttons(self._last_display)
-                self.queue_display.put(self._last_display)
+            self.calibrate()
                 
+    def calibrate(self,timeout = 0):
+        """
+        Start calibrating from the samples collected so far in a background CalibrationJob, stopped after
+        timeout seconds if not 0. Returns the job, or None if there aren't enough samples yet or a calibration
+        is already running.
+        """
+        with self._c_lock:
+            if self.c is None or not self.c.goodenough or self.c.calibrated:
+                return None
+            if self.job is not None and not self.job.finished:
+                return None
+            self.job = CalibrationJob(self.run_calibration,timeout)
+        self.job.on_update = lambda job : self.publish_progress()
+        self.job.start()
+        return self.job
+    
+    def run_calibration(self,job):
+        METRICS.bind_camera(self._camera)
+        # let a live preview solve in progress finish first, its estimate is the starting point
+        preview = self._estimate_thread
+        if preview is not None:
+            job.step(0.0,"waiting for the live preview")
+            preview.join()
+        self.logger.info("########## CALIBRATING ##########")
+        self.c.do_calibration(job = job)
+        if self.overlay and self._last_display is not None:
+            self.buttons(self._last_display)
+            self.queue_display.put(self._last_display)
+        
     def on_model_change(self,model_select_val):
         if self.c == None:
             print("Cannot change camera model until the first image has been receives")
@@ -174,6 +413,11 @@ class OpenCVCalibrationNode(CalibrationNode):
         print("Saved screen dump to /tmp/dump%d.png"%i)
         
     def redraw_monocular(self,drawable):
+        if not self.overlay:
+            self._last_display = drawable.scrib
+            self.queue_display.put(drawable.scrib)
+            return
+        
         height = drawable.scrib.shape[0]
         width = drawable.scrib.shape[1]
         
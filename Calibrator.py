@@ -1,6 +1,10 @@
 from utils import *
 import tarfile
 from params import Params
+from calib_cache import CornerCache , MapCache
+from SampleStore import make_sample_store
+from calib_logger import CalibLogger
+from metrics import METRICS
 
 class Calibrator():
     """
@@ -11,9 +15,12 @@ class Calibrator():
                  flags = 0,
                  fisheye_flags = 0,
                  checkerboard_flags = cv2.CALIB_CB_FAST_CHECK,
-                 max_chessboard_speed = -1.0):
+                 max_chessboard_speed = -1.0,
+                 params = None):
         
-        self.params = Params()
+        # configuration, parsed from the command line unless given (e.g. by a benchmark)
+        self.params = params if params is not None else Params()
+        self.logger = CalibLogger().get_logger()
 
         # Make sure n_cols > n_rows to agree with OpenCV CB detector outupt
         self._boards = [ChessboardInfo(max(i.n_cols,i.n_rows),min(i.n_cols,i.n_rows),i.dim) for i in boards]
@@ -28,20 +35,66 @@ class Calibrator():
         
         # self.db is list of (parameters,image) samples for use in calibration.
         # parameters has form (X,Y,size,skew) all normalized to [0,1], to keep track of what sort of samples we've taken and ensure enough variety
+        # image is the reference returned by self.sample_store, use self.sample_store.get to read it.
         self.db = []
+        self.sample_store = make_sample_store(self.params.args)
         # for each db sample, we also record the detected corners.
         self.good_corners = []
         # Set to true when we have sufficiently varied samples to calibrate
         self.goodenough = False
+        # the live preview estimate has stopped changing, see MonoCalibrator.update_estimate
+        self.converged = False
         self.param_ranges = [0.7,0.7,0.4,0.5]
+        # A new sample must be at least this far (L1 distance of the parameters) from all the samples in the database.
+        # TODO what's a good threshold here ? should it be configurable?
+        self.min_sample_distance = 0.2
+        # spatial index over the parameters of self.db, kept in sync by add_sample
+        self.sample_index = SampleIndex(self.min_sample_distance)
+        # Running coverage of the samples in self.db, updated by add_sample only
+        self._min_params = None
+        self._max_params = None
+        self._goodenough_params = None
+        # optional per-parameter histogram of the samples, e.g. for showing coverage in the UI
+        self.param_histograms = None
+        if self.params.args.coverage_bins > 0:
+            self.param_histograms = numpy.zeros((len(self._param_names),self.params.args.coverage_bins),dtype = numpy.int64)
         self.last_frame_corners = None
         self.max_chessboard_speed = max_chessboard_speed
         
+        # Search the board around last_frame_corners first, see downsample_and_track
+        self.roi_tracking = self.params.args.roi_tracking
+        self.tracking_stats = {"roi_frames" : 0,"roi_hits" : 0,"full_frames" : 0,"roi_hit_time" : 0.0,"roi_miss_time" : 0.0,"full_time" : 0.0}
+        
+        # Number of pixels of the image the board is detected in. With a latency budget, it is tuned to hold it.
+        self.detect_area = self.params.args.detection_area
+        self.target_detect_latency = self.params.args.detection_latency_ms / 1000.0
+        self.detect_latency = None
+        self._frames_since_tune = 0
+        self._detect_misses = 0
+        
+        # Optional cheap tests skipping the detector for useless frames
+        self.frame_gate = None
+        if self.params.args.frame_gate:
+            self.frame_gate = FrameGate(self._boards,self.params.args.gate_min_sharpness,self.params.args.gate_static_threshold,
+                                        presence_test = not (self.checkerboard_flags & cv2.CALIB_CB_FAST_CHECK),
+                                        max_static = self.params.args.gate_max_static)
+        # detection of the last handled frame, reused for static frames
+        self.last_detection = None
+        
+        # Corners detected in stored images are cached on disk, so re-detecting them (e.g. in do_calibration) is free
+        self.corner_cache = None
+        if self.params.args.corner_cache_size > 0:
+            self.corner_cache = CornerCache(self.params.args.corner_cache_dir,self.params.args.corner_cache_size * 1024 * 1024)
+        
     def mkgray(self,img):
         """
         Convert RGB image to GrayScale image
         """
-        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # frames may already have been converted, e.g. before being sent to the detection workers
+        if len(img.shape) == 2:
+            return img
+        with METRICS.timer("mkgray"):
+            return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
     def get_parameters(self,corners,board,size):
         """
@@ -91,15 +144,8 @@ class Calibrator():
         if not self.db:
             return True
         
-        def param_distance(p1,p2):
-            return sum([abs(a-b) for (a,b) in zip(p1,p2)])
-        
-        db_params = [sample[0] for sample in self.db]
-        d = min([param_distance(params,p) for p in db_params])
-        
-        # TODO what's a good threshold here ? should it be configurable?
-        
-        if d <= 0.2:
+        # Only samples within min_sample_distance matter, the index finds them without scanning the database.
+        if self.sample_index.min_distance(params,self.min_sample_distance) is not None:
             return False 
         
         if self.max_chessboard_speed > 0:
@@ -109,28 +155,59 @@ class Calibrator():
         # All tests passed , image should be good for calibration
         return True
 
+    def add_sample(self,params,image,corners,board):
+        """
+        Add a sample to the database, keeping the derived state in sync.
+        """
+        self.size = (image.shape[1],image.shape[0])
+        self.db.append((params,self.sample_store.put(image)))
+        self.good_corners.append((corners,board))
+        self.sample_index.add(params)
+        
+        # Extend the range of checkerboard poses covered by samples in database
+        if self._min_params is None:
+            self._min_params = list(params)
+            self._max_params = list(params)
+        else:
+            self._min_params = lmin(self._min_params,params)
+            self._max_params = lmax(self._max_params,params)
+            
+        if self.param_histograms is not None:
+            bins = self.param_histograms.shape[1]
+            for (i,p) in enumerate(params):
+                self.param_histograms[i,min(bins-1,max(0,int(p * bins)))] += 1
+                
+        self._goodenough_params = self.update_goodenough()
+        
     _param_names = ["x","Y","Size","Skew"]
     
     def compute_goodenough(self):
+        """
+        Returns [(label,min,max,progress)] for each parameter, None while the database is empty.
+        Only recomputed when a sample is added, so it is cheap to call on every frame.
+        """
         if not self.db:
             return None 
-        
-        # Find range of checkerboard poses covered by samples in database
-        all_params = [sample[0] for sample in self.db]
-        min_params = all_params[0]
-        max_params = all_params[0]
-        for params in all_params[1:]:
-            min_params = lmin(min_params,params)
-            max_params = lmax(max_params,params)
-            
+        return self._goodenough_params
+    
+    def coverage(self):
+        """
+        Returns [(label,histogram)] of the samples in the database, None if --coverage_bins is 0.
+        """
+        if self.param_histograms is None:
+            return None
+        return list(zip(self._param_names,self.param_histograms.tolist()))
+    
+    def update_goodenough(self):
         # Don't reward small size or skew
-        min_params = [min_params[0],min_params[1],0.,0.]
+        min_params = [self._min_params[0],self._min_params[1],0.,0.]
+        max_params = self._max_params
         
         # For each parameter, judge how much progress has been made toward adequate variation.
         progress = [min((hi - lo)/r,1.0) for (lo,hi,r) in zip(min_params,max_params,self.param_ranges)]
         # If we have lots of samples, allow calibration even if not all parameters are given
         # self.goodenough = (len(self.db) >= 40) or all([p == 1.0 for p in progress])
-        self.goodenough = (len(self.db) >= self.params.args.sample_count) or all([p == 1.0 for p in progress])
+        self.goodenough = (len(self.db) >= self.params.args.sample_count) or all([p == 1.0 for p in progress]) or self.converged
         
         return list(zip(self._param_names,min_params,max_params,progress))
     
@@ -156,13 +233,25 @@ class Calibrator():
         
         Returns (ok,corners,board)
         """
+        return get_board_corners(img,self._boards,refine,self.checkerboard_flags)
+    
+    def get_corners_cached(self,img,refine = True):
+        """
+        Same as get_corners, but looks the image up in the corner cache first.
         
-        for b in self._boards:
-            (ok,corners) = get_corners(img,b,refine,self.checkerboard_flags)
-            
-            if ok:
-                return (ok,corners,b)
-        return (False,None,None)
+        Returns (ok,corners,board)
+        """
+        if self.corner_cache is None:
+            return self.get_corners(img,refine)
+        
+        key = self.corner_cache.key(self.corner_cache.image_data(img),self._boards,self.checkerboard_flags,refine)
+        cached = self.corner_cache.get(key,self._boards)
+        if cached is not None:
+            return cached[:3]
+        
+        (ok,corners,board) = self.get_corners(img,refine)
+        self.corner_cache.put(key,(ok,corners,board,(img.shape[1],img.shape[0])),self._boards)
+        return (ok,corners,board)
     
     def downsample_and_detect(self,img):
         """
@@ -175,42 +264,128 @@ class Calibrator():
         
         Returns (scrib,corners,downsampled_corners,board,(x_scale,y_scale))
         """
-        height = img.shape[0]
-        width = img.shape[1]
-        scale = math.sqrt((width*height)/(640.*480.))
-        
-        if scale > 1.0:
-            scrib = cv2.resize(img,(int(width/scale),int(height/scale)))
+        (detection,roi_hit,detect_time) = downsample_and_track(img,self._boards,self.checkerboard_flags,self.tracked_corners(),self.detect_area)
+        self.record_detection(detection,roi_hit,detect_time)
+        return detection
+    
+    def gate_frame(self,gray):
+        """
+        Returns the reason why the detection of this frame can be skipped, None if it has to be detected.
+        """
+        if self.frame_gate is None:
+            return None
+        return self.frame_gate.check(gray,self.detect_area)
+    
+    def gated_detection(self,gray,reason):
+        """
+        Detection result of a frame skipped by the gate : the previous detection for a static frame, no board otherwise.
+        """
+        height = gray.shape[0]
+        width = gray.shape[1]
+        scrib = cv2.resize(gray,display_size((width,height))) if (width,height) != display_size((width,height)) else gray
+        scales = (float(width) / scrib.shape[1],float(height) / scrib.shape[0])
+        
+        if reason == "static" and self.last_detection is not None:
+            (_,corners,downsampled_corners,board,_) = self.last_detection
+            return (scrib,corners,downsampled_corners,board,scales)
+        return (scrib,None,None,None,scales)
+    
+    def tracked_corners(self):
+        """
+        Corners of the previous detection to track, None if tracking is off.
+        """
+        return self.last_frame_corners if self.roi_tracking else None
+    
+    def record_detection(self,detection,roi_hit,detect_time):
+        """
+        Account for a detection returned by downsample_and_track.
+        """
+        # whole detection, also when it ran in a worker process
+        METRICS.observe("detect",detect_time)
+        self.record_tracking(roi_hit,detect_time)
+        if self.target_detect_latency > 0:
+            (scrib,corners,_,_,(x_scale,y_scale)) = detection
+            self.tune_detection(detect_time,scrib.shape[0] * y_scale * scrib.shape[1] * x_scale,corners is not None)
+            
+    def tune_detection(self,detect_time,image_area,found):
+        """
+        Adjust the detection resolution so that the detection latency stays within the budget.
+        """
+        if not found:
+            # Frames without a board say nothing about the latency, but a board too small to be found
+            # at the current resolution looks just like that. Move back towards the configured resolution.
+            self._detect_misses += 1
+            if self._detect_misses >= 30 and self.detect_area < self.params.args.detection_area:
+                self.detect_area = min(self.params.args.detection_area,int(self.detect_area * 1.25))
+                self._detect_misses = 0
+                self._frames_since_tune = 0
+            return
+        self._detect_misses = 0
+        
+        # smoothed latency of the successful detections
+        if self.detect_latency is None:
+            self.detect_latency = detect_time
         else:
-            scrib = img 
+            self.detect_latency = 0.8 * self.detect_latency + 0.2 * detect_time
+        self._frames_since_tune += 1
+        
+        # let the latency settle after a change before judging it again
+        if self._frames_since_tune < 10:
+            return
+        
+        area = self.detect_area
+        if self.detect_latency > self.target_detect_latency:
+            area = max(160 * 120,int(area * 0.8))
+        elif self.detect_latency < 0.5 * self.target_detect_latency:
+            area = min(int(image_area),int(area * 1.25))
             
-        # Due to rounding, actual horizontal/vertical scaling may differ slightly
-        x_scale = float(width) / scrib.shape[1]
-        y_scale = float(height) / scrib.shape[0]
-        
-        # Detect checkerboard
-        (ok,downsampled_corners,board) = self.get_corners(scrib,refine = True)
-        
-        # scale corners back to full size image
-        corners = None 
-        if ok:
-            if scale > 1.0:
-                # Refine up-scaled corners in the original full-res image
-                corners_unrefined = downsampled_corners.copy()
-                corners_unrefined[:,:,0] *= x_scale
-                corners_unrefined[:,:,1] *= y_scale
-                radius = int(math.ceil(scale))
-                if len(img.shape) == 3 and img.shape[2] == 3:
-                    mono = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-                else:
-                    mono = img 
-                cv2.cornerSubPix(mono,corners_unrefined,(radius,radius),(-1,-1),(cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER,30,0.1))
-                
-                corners = corners_unrefined
+        if area != self.detect_area:
+            self.logger.debug("Detection resolution %d -> %d pixels (latency %.1f ms)" % (self.detect_area,area,self.detect_latency * 1000))
+            self.detect_area = area
+            self._frames_since_tune = 0
+            
+    def record_tracking(self,roi_hit,detect_time):
+        stats = self.tracking_stats
+        if roi_hit is None:
+            stats["full_frames"] += 1
+            stats["full_time"] += detect_time
+        else:
+            stats["roi_frames"] += 1
+            if roi_hit:
+                stats["roi_hits"] += 1
+                stats["roi_hit_time"] += detect_time
             else:
-                corners = downsampled_corners
-        
-        return (scrib,corners,downsampled_corners,board,(x_scale,y_scale))
+                stats["roi_miss_time"] += detect_time
+                
+    def tracking_report(self):
+        """
+        Returns (hit_rate,time_saved) of the ROI tracking. The time saved is estimated against the average
+        time of a full frame detection, and includes the time lost searching the ROI on misses.
+        """
+        stats = self.tracking_stats
+        if stats["roi_frames"] == 0:
+            return (0.0,0.0)
+        hit_rate = stats["roi_hits"] / float(stats["roi_frames"])
+        full_avg = stats["full_time"] / stats["full_frames"] if stats["full_frames"] else 0.0
+        # a miss costs the ROI search on top of the full frame detection
+        roi_misses = stats["roi_frames"] - stats["roi_hits"]
+        time_saved = (stats["roi_hits"] * full_avg - stats["roi_hit_time"]) - (stats["roi_miss_time"] - roi_misses * full_avg)
+        return (hit_rate,time_saved)
+    
+    def detection_stats(self):
+        """
+        ROI tracking hit rate and time saved, and frames detected or skipped per reason by the frame gate,
+        for the features enabled.
+        """
+        stats = dict()
+        if self.roi_tracking:
+            (hit_rate,time_saved) = self.tracking_report()
+            stats["roi_hit_rate"] = round(hit_rate,3)
+            stats["roi_time_saved_s"] = round(time_saved,3)
+        if self.frame_gate is not None:
+            stats["gate_detected_frames"] = self.frame_gate.passed
+            stats["gate_skipped_frames"] = dict(self.frame_gate.skipped)
+        return stats
     
     @staticmethod
     def lrreport(d,k,r,p):
@@ -259,7 +434,7 @@ class Calibrator():
     def lryaml(d,k,r,p,size,cam_model):
         def format_mat(x,precision):
             return ("[%s]" %(
-                numpy.array2string(x,precision = precision , suppress_small = True , seperator = ", ").replace("[","").replace("]","").replace("\n","\n          ")
+                numpy.array2string(x,precision = precision , suppress_small = True , separator = ", ").replace("[","").replace("]","").replace("\n","\n          ")
             ))
             
         dist_model = get_dist_model(d,cam_model)
@@ -0,0 +1,149 @@
+from utils import *
+from calib_logger import CalibLogger
+from metrics import METRICS
+
+import time
+
+
+class CameraCapture():
+    """
+    V4L2 capture of a camera, negotiating the pixel format (FOURCC), the number of driver buffers and the frame rate.
+    
+    Frames are read in the capturing thread and decoded in a thread of their own. With MJPG the compressed
+    frames are read as they come from the camera and decoded straight to grayscale, which is all the
+    calibration needs; other formats are converted by OpenCV while reading.
+    """
+    # seconds release() waits for the decoding thread
+    RELEASE_TIMEOUT = 5.0
+    
+    def __init__(self,cam_index,img_w,img_h,fourcc = "MJPG",fps = 30,buffers = 2,camera = None):
+        self._cam_index = cam_index
+        # camera label of the metrics
+        self._camera = camera
+        self._img_w = img_w
+        self._img_h = img_h
+        self._fourcc = fourcc
+        self._fps = fps
+        self._buffers = buffers
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self.cap = None
+        self.compressed = False
+        self.q_raw = BufferQueue(maxsize = 2,name = "decode",camera = camera)
+        self._dth = None
+        
+        # capture statistics
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.missed = 0
+        self.read_time = 0.0
+        self.fps = 0.0
+        self._last_stamp = None
+        self._last_read = None
+        
+    def open(self):
+        self.cap = cv2.VideoCapture(self._cam_index,cv2.CAP_V4L2)
+        if not self.cap.isOpened():
+            # e.g. not a V4L2 device, let OpenCV pick the backend
+            self.cap = cv2.VideoCapture(self._cam_index)
+        if not self.cap.isOpened():
+            self.logger.error("Could not open camera %s" % (self._cam_index,))
+            return False
+            
+        # The format has to be set before the size for the driver to offer the high resolution modes
+        if self._fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC,cv2.VideoWriter_fourcc(*self._fourcc))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH,self._img_w)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT,self._img_h)
+        if self._fps > 0:
+            self.cap.set(cv2.CAP_PROP_FPS,self._fps)
+        if self._buffers > 0:
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE,self._buffers)
+            
+        fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC))
+        fourcc = "".join([chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)])
+        # only the V4L2 backend hands out the raw MJPG buffers
+        self.compressed = (fourcc == "MJPG" and self.cap.getBackendName() == "V4L2")
+        if self.compressed:
+            # hand over the JPEG data, the decoding thread decodes it
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB,0)
+            
+        self.logger.info("Camera %s : %s %dx%d @ %.1f fps , %d buffers" % (self._cam_index,fourcc,
+                                                                          self.cap.get(cv2.CAP_PROP_FRAME_WIDTH),
+                                                                          self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT),
+                                                                          self.cap.get(cv2.CAP_PROP_FPS),
+                                                                          self.cap.get(cv2.CAP_PROP_BUFFERSIZE)))
+        return True
+    
+    def run(self,put):
+        """
+        Capture until released, passing the decoded frames to put. Blocks the calling thread.
+        """
+        if not self.open():
+            return
+        
+        self._dth = ConsumerThread(self.q_raw,lambda raw : self.decode(raw,put),self._camera)
+        self._dth.daemon = True
+        self._dth.start()
+        
+        while self.cap.isOpened():
+            start = time.perf_counter()
+            ret,raw = self.cap.read()
+            if ret:
+                read_time = time.perf_counter() - start
+                METRICS.observe("capture_read",read_time)
+                self.update_stats(read_time,self.cap.get(cv2.CAP_PROP_POS_MSEC))
+                self.q_raw.put(raw)
+                
+    def decode(self,raw,put):
+        if self.compressed:
+            with METRICS.timer("decode"):
+                frame = cv2.imdecode(raw.reshape(-1),cv2.IMREAD_GRAYSCALE)
+            if frame is None:
+                return
+        else:
+            frame = raw
+        put(frame)
+        
+    def update_stats(self,read_time,stamp_ms):
+        now = time.perf_counter()
+        with self._lock:
+            self.frames += 1
+            # smoothed read latency and frame rate
+            self.read_time = read_time if self.frames == 1 else 0.9 * self.read_time + 0.1 * read_time
+            if self._last_read is not None and now > self._last_read:
+                rate = 1.0 / (now - self._last_read)
+                self.fps = rate if self.frames == 2 else 0.9 * self.fps + 0.1 * rate
+            self._last_read = now
+            
+            # frames the driver skipped show up as gaps in the buffer timestamps
+            if self._fps > 0 and stamp_ms > 0 and self._last_stamp is not None:
+                period = 1000.0 / self._fps
+                gap = stamp_ms - self._last_stamp
+                if gap > 1.5 * period:
+                    self.missed += int(round(gap / period)) - 1
+            self._last_stamp = stamp_ms
+            
+    def stats(self):
+        """
+        Measured capture statistics : frame rate, read latency and frames lost in the camera/driver or dropped
+        before decoding.
+        """
+        with self._lock:
+            return {
+                "frames" : self.frames,
+                "fps" : round(self.fps,2),
+                "read_latency_ms" : round(self.read_time * 1000.0,3),
+                "missed_frames" : self.missed,
+                "decode_dropped_frames" : self.q_raw.dropped
+            }
+        
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+        if self._dth is not None:
+            self._dth.stop()
+            self._dth.join(self.RELEASE_TIMEOUT)
+            if self._dth.is_alive():
+                self.logger.warning("Decoding thread of camera %s still busy after %g s" % (self._cam_index,self.RELEASE_TIMEOUT))
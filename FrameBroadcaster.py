@@ -0,0 +1,268 @@
+from utils import *
+from calib_logger import CalibLogger
+from metrics import METRICS
+
+from queue import Empty
+from collections import Counter
+
+
+class StreamClient():
+    """
+    Stream settings and statistics of one client watching the preview.
+    
+    In adaptive mode the JPEG quality, then the frame rate, are lowered while the encoder or the client
+    can't keep up with the display, and raised back towards the requested values once they can. The quality
+    of adaptive clients only takes the values of QUALITY_LADDER, so that they share the encoded variants
+    instead of each stepping to a quality of its own.
+    """
+    QUALITY_LADDER = (95,75,50)
+    MIN_FPS = 2.0
+    # frames without lag before stepping the quality or the frame rate back up
+    STEADY_FRAMES = 30
+    
+    def __init__(self,quality = 95,max_fps = 0,scale = 1.0,adaptive = False):
+        self.max_quality = min(max(int(quality),1),100)
+        self.adaptive = adaptive
+        if adaptive:
+            # highest rung not above the requested quality
+            self.max_quality = max([q for q in self.QUALITY_LADDER if q <= self.max_quality] or [self.QUALITY_LADDER[-1]])
+        self.quality = self.max_quality
+        # requested frame rate cap, 0 sends every display frame
+        self.max_fps = max(float(max_fps),0.0)
+        self.fps_cap = self.max_fps
+        self.scale = min(max(float(scale),0.1),1.0)
+        
+        self._steady = 0
+        self._start = time.perf_counter()
+        self._last_sent = None
+        self.frames = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.send_time = 0.0
+    
+    def variant(self):
+        return (self.quality,self.scale)
+    
+    def wait_time(self):
+        """
+        Time left before the next frame may be sent under the frame rate cap.
+        """
+        if self.fps_cap <= 0 or self._last_sent is None:
+            return 0.0
+        return max(0.0,self._last_sent + 1.0 / self.fps_cap - time.perf_counter())
+    
+    def sent(self,nbytes,skipped,send_time):
+        self._last_sent = time.perf_counter()
+        self.frames += 1
+        self.skipped += skipped
+        self.bytes += nbytes
+        self.send_time = send_time if self.frames == 1 else 0.9 * self.send_time + 0.1 * send_time
+    
+    def adapt(self,send_time,encode_time,frame_period):
+        """
+        Step the quality and frame rate down when the last frame took longer to encode or to send than the
+        display or the client allow, and back up after STEADY_FRAMES frames without lag.
+        """
+        if not self.adaptive or frame_period <= 0:
+            return
+        period = max(frame_period,1.0 / self.fps_cap) if self.fps_cap > 0 else frame_period
+        encoder_behind = encode_time > 0.8 * frame_period
+        client_behind = send_time > 0.8 * period
+        
+        if encoder_behind or client_behind:
+            self._steady = 0
+            lower = [q for q in self.QUALITY_LADDER if q < self.quality]
+            if lower:
+                self.quality = lower[0]
+            else:
+                fps = self.fps_cap if self.fps_cap > 0 else 1.0 / frame_period
+                self.fps_cap = max(self.MIN_FPS,0.75 * fps)
+            return
+        
+        self._steady += 1
+        if self._steady < self.STEADY_FRAMES:
+            return
+        self._steady = 0
+        if self.fps_cap > 0 and (self.max_fps == 0 or self.fps_cap < self.max_fps):
+            self.fps_cap *= 1.25
+            if self.max_fps > 0:
+                self.fps_cap = min(self.fps_cap,self.max_fps)
+            elif self.fps_cap >= 1.0 / frame_period:
+                # back to the display rate
+                self.fps_cap = 0.0
+        elif self.quality < self.max_quality:
+            self.quality = min(q for q in self.QUALITY_LADDER if q > self.quality)
+    
+    def stats(self):
+        elapsed = max(time.perf_counter() - self._start,1e-6)
+        return {
+            "quality" : self.quality,
+            "scale" : self.scale,
+            "fps_cap" : round(self.fps_cap,2),
+            "adaptive" : self.adaptive,
+            "frames" : self.frames,
+            "skipped_frames" : self.skipped,
+            "fps" : round(self.frames / elapsed,2),
+            "bytes_per_sec" : int(self.bytes / elapsed),
+            "send_ms" : round(self.send_time * 1000.0,3)
+        }
+
+
+class FrameBroadcaster():
+    """
+    Encodes every display frame of a calibration session to JPEG once and hands the same bytes to all the
+    clients watching the stream.
+    
+    The encoding thread blocks on the display queue, and the clients block on a condition variable until a
+    newer frame than the one they sent last is available, so neither spins while there is nothing to send.
+    A slow client simply skips the frames it was too late for.
+    
+    Clients asking for a different JPEG quality or scale subscribe to their own variant of the stream,
+    each variant is still encoded once per frame whatever the number of clients watching it.
+    """
+    
+    def __init__(self,queue_display,camera = None):
+        self._queue_display = queue_display
+        # camera label of the encoding metrics
+        self._camera = camera
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self._cond = threading.Condition()
+        # encoded frames of the latest display frame per (quality,scale) and its sequence number
+        self.encoded = dict()
+        self.seq = 0
+        # (quality,scale) -> number of clients watching it
+        self.variants = Counter()
+        self.clients = set()
+        self._running = False
+        self._thread = None
+        
+        # smoothed encoding time per variant and display frame period
+        self.encode_time = dict()
+        self.frame_period = 0.0
+        self._last_frame = None
+    
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target = self.run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        with self._cond:
+            self._running = False
+            # wake the clients up so that their streams end
+            self._cond.notify_all()
+    
+    def run(self):
+        METRICS.bind_camera(self._camera)
+        while self._running:
+            try:
+                # timeout only to notice stop()
+                image = self._queue_display.get(timeout = 0.5)
+            except Empty:
+                continue
+            now = time.perf_counter()
+            if self._last_frame is not None:
+                period = now - self._last_frame
+                self.frame_period = period if self.frame_period == 0 else 0.9 * self.frame_period + 0.1 * period
+            self._last_frame = now
+            
+            with self._cond:
+                # nobody watching means nothing to encode
+                variants = list(self.variants)
+            encoded = dict()
+            for variant in variants:
+                data = self.encode(image,variant)
+                if data is not None:
+                    encoded[variant] = data
+            if not encoded:
+                continue
+            
+            with self._cond:
+                self.encoded = encoded
+                self.seq += 1
+                self._cond.notify_all()
+    
+    def encode(self,image,variant):
+        (quality,scale) = variant
+        start = time.perf_counter()
+        if scale < 1.0:
+            image = cv2.resize(image,None,fx = scale,fy = scale,interpolation = cv2.INTER_AREA)
+        ret , buffer = cv2.imencode(".jpg",image,[cv2.IMWRITE_JPEG_QUALITY,quality])
+        elapsed = time.perf_counter() - start
+        METRICS.observe("jpeg_encode",elapsed)
+        with self._cond:
+            if variant in self.variants:
+                previous = self.encode_time.get(variant)
+                self.encode_time[variant] = elapsed if previous is None else 0.9 * previous + 0.1 * elapsed
+        if not ret:
+            return None
+        return buffer.tobytes()
+    
+    def _subscribe(self,variant):
+        self.variants[variant] += 1
+    
+    def _unsubscribe(self,variant):
+        self.variants[variant] -= 1
+        if self.variants[variant] <= 0:
+            del self.variants[variant]
+            self.encode_time.pop(variant,None)
+    
+    def frames(self,quality = 95,max_fps = 0,scale = 1.0,adaptive = False):
+        """
+        Generator of the encoded frames for one client, ends when the broadcaster is stopped.
+        """
+        client = StreamClient(quality,max_fps,scale,adaptive)
+        with self._cond:
+            variant = client.variant()
+            self._subscribe(variant)
+            self.clients.add(client)
+            # the variant may not have been encoded for the latest frame, wait for a fresh one
+            last = self.seq
+        try:
+            while True:
+                # frame rate cap, the frames displayed meanwhile are skipped
+                wait = client.wait_time()
+                if wait > 0:
+                    time.sleep(wait)
+                with self._cond:
+                    self._cond.wait_for(lambda : not self._running or (self.seq > last and variant in self.encoded))
+                    if not self._running:
+                        return
+                    frame = self.encoded[variant]
+                    skipped = self.seq - last - 1
+                    last = self.seq
+                    encode_time = self.encode_time.get(variant,0.0)
+                
+                start = time.perf_counter()
+                # returns once the server has written the frame to the client
+                yield frame
+                send_time = time.perf_counter() - start
+                
+                client.sent(len(frame),skipped,send_time)
+                client.adapt(send_time,encode_time,self.frame_period)
+                if client.variant() != variant:
+                    with self._cond:
+                        self._unsubscribe(variant)
+                        variant = client.variant()
+                        self._subscribe(variant)
+        finally:
+            with self._cond:
+                self._unsubscribe(variant)
+                self.clients.discard(client)
+    
+    def stats(self):
+        """
+        Encoding time of every variant being streamed, the display frame period, and per client the quality,
+        frame rate and bytes/sec actually sent.
+        """
+        with self._cond:
+            clients = list(self.clients)
+            encode_time = dict(self.encode_time)
+        return {
+            "frame_period_ms" : round(self.frame_period * 1000.0,3),
+            "encode_ms" : {"q%d_s%.2f" % variant : round(t * 1000.0,3) for variant , t in encode_time.items()},
+            "clients" : [client.stats() for client in clients]
+        }
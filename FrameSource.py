@@ -0,0 +1,165 @@
+from utils import *
+from calib_logger import CalibLogger
+
+import os
+import tarfile
+
+
+class FrameSource():
+    """
+    Recorded frames replayed in place of a camera, with the interface of CameraCapture : run(put) feeds
+    the frames to put from the capturing thread, stats() and release().
+    
+    rate is "native" (the recording's own frame rate), "fast" (as fast as the calibrator takes them, without
+    dropping any : is_lossless) or a fixed frame rate.
+    """
+    IMAGE_EXTENSIONS = (".png",".pgm",".jpg",".jpeg",".bmp")
+    
+    def __init__(self,rate = "native",native_fps = 30.0):
+        self.rate = rate
+        self.native_fps = native_fps
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self._released = False
+        self.done = threading.Event()
+        self.frames = 0
+        self._start = None
+        self._end = None
+    
+    @property
+    def is_lossless(self):
+        return self.rate == "fast"
+    
+    def period(self):
+        """
+        Time between two frames, 0 for as fast as possible.
+        """
+        if self.rate == "fast":
+            return 0.0
+        fps = self.native_fps if self.rate == "native" else float(self.rate)
+        return 1.0 / fps if fps > 0 else 0.0
+    
+    def open(self):
+        """
+        Called before the replay starts, by the sources having to open the recording to know its native_fps.
+        """
+        pass
+    
+    def read_frames(self):
+        """
+        Generator of the recorded frames, implemented by every source.
+        """
+        raise NotImplementedError
+    
+    def run(self,put):
+        try:
+            self.open()
+            period = self.period()
+            self._start = time.perf_counter()
+            for frame in self.read_frames():
+                if self._released:
+                    break
+                if period > 0:
+                    # hold the frame until its time, relative to the start so that the rate does not drift
+                    delay = self._start + self.frames * period - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                put(frame)
+                self.frames += 1
+        finally:
+            self._end = time.perf_counter()
+            self.logger.info("Replayed %d frames from %s" % (self.frames,self))
+            self.done.set()
+    
+    def stats(self):
+        if self._start is None:
+            return {"frames" : 0,"fps" : 0.0}
+        elapsed = (self._end or time.perf_counter()) - self._start
+        return {"frames" : self.frames,"fps" : round(self.frames / elapsed,2) if elapsed > 0 else 0.0,"done" : self.done.is_set()}
+    
+    def release(self):
+        self._released = True
+
+
+class VideoFileSource(FrameSource):
+    """
+    Frames of a video file, at the frame rate recorded in the file when native.
+    """
+    def __init__(self,path,rate = "native"):
+        FrameSource.__init__(self,rate)
+        self.path = path
+        self._cap = None
+    
+    def open(self):
+        self._cap = cv2.VideoCapture(self.path)
+        if not self._cap.isOpened():
+            raise CalibrationException("Could not open video %s" % self.path)
+        if self._cap.get(cv2.CAP_PROP_FPS) > 0:
+            self.native_fps = self._cap.get(cv2.CAP_PROP_FPS)
+    
+    def read_frames(self):
+        cap = self._cap
+        try:
+            while True:
+                ret,frame = cap.read()
+                if not ret:
+                    break
+                yield frame
+        finally:
+            cap.release()
+    
+    def __str__(self):
+        return self.path
+
+
+class ImageDirectorySource(FrameSource):
+    """
+    Images of a directory in name order, replayed at native_fps when native.
+    """
+    def __init__(self,path,rate = "native",native_fps = 30.0):
+        FrameSource.__init__(self,rate,native_fps)
+        self.path = path
+    
+    def read_frames(self):
+        # 8 bit gray whatever the file, as the calibrator's tar archives and the batch calibration decode them
+        for f in sorted(os.listdir(self.path)):
+            if os.path.splitext(f)[1].lower() in self.IMAGE_EXTENSIONS:
+                frame = cv2.imread(os.path.join(self.path,f),cv2.IMREAD_GRAYSCALE)
+                if frame is not None:
+                    yield frame
+    
+    def __str__(self):
+        return self.path
+
+
+class TarArchiveSource(FrameSource):
+    """
+    Sample images of a tar archive written by MonoCalibrator.do_tarfile_save, replayed at native_fps when native.
+    """
+    def __init__(self,path,rate = "native",native_fps = 30.0):
+        FrameSource.__init__(self,rate,native_fps)
+        self.path = path
+    
+    def read_frames(self):
+        with tarfile.open(self.path,"r") as archive:
+            for name in sorted(archive.getnames()):
+                if os.path.splitext(name)[1].lower() in self.IMAGE_EXTENSIONS:
+                    buf = numpy.frombuffer(archive.extractfile(name).read(),numpy.uint8)
+                    frame = cv2.imdecode(buf,cv2.IMREAD_GRAYSCALE)
+                    if frame is not None:
+                        yield frame
+    
+    def __str__(self):
+        return self.path
+
+
+def open_source(path,rate = "native",native_fps = 30.0):
+    """
+    Frame source for a recording : an image directory, a tar archive or else a video file.
+    """
+    if os.path.isdir(path):
+        return ImageDirectorySource(path,rate,native_fps)
+    if tarfile.is_tarfile(path):
+        return TarArchiveSource(path,rate,native_fps)
+    return VideoFileSource(path,rate)
@@ -1,6 +1,11 @@
 from Calibrator import *
 from calib_logger import CalibLogger
+from metrics import METRICS
+from SampleStore import SpoolSampleStore
 
+import os
+import functools
+import itertools
 import pickle
 import random
 from io import BytesIO
@@ -15,11 +20,27 @@ class MonoCalibrator(Calibrator):
         print(mc.as_message())
     """
     is_mono = True
+    # a robust calibration never rejects views below this count, and the live preview waits for as many
+    MIN_VIEWS = 5
+    # largest relative change of fx,fy,cx,cy between live preview estimates, twice in a row, for them to have converged
+    CONVERGED_CHANGE = 0.002
+    # image grid (columns,rows) the corner coverage of the views is counted in when selecting them
+    COVERAGE_GRID = (8,6)
     
     def __init__(self,*args,**kwargs):
         super(MonoCalibrator,self).__init__(*args,**kwargs)
         self.logger = CalibLogger().get_logger()
         
+        self.map_cache = MapCache(self.params.args.map_cache_entries,self.params.args.map_cache_dir,self.params.args.map_cache_size * 1024 * 1024)
+        self.alpha = 0.0
+        self.robust_report = None
+        # RMS reprojection error (px) of the last calibration
+        self.reproj_err = None
+        # latest live preview solution, see update_estimate
+        self.estimate = None
+        # views selected by the last calibration with --max_calib_samples, see cal_fromcorners
+        self.selection_report = None
+        
         
     def cal(self,images):
         """
@@ -29,10 +50,11 @@ class MonoCalibrator(Calibrator):
         self.cal_fromcorners(goodcorners)
         self.calibrated = True
         
-    def collect_corners(self,images):
+    def collect_corners(self,images,job = None):
         """
         :param images: source images containing chessboards
         :type images: list of : class : "cvMat"
+        :param job: optional CalibrationJob the progress is reported to, as the first half of the calibration
         
         Find chessboards in all images.
         
@@ -40,68 +62,367 @@ class MonoCalibrator(Calibrator):
         """
         
         self.size = (images[0].shape[1],images[0].shape[0])
-        corners = [self.get_corners(i) for i in images]
+        corners = []
+        for (n,i) in enumerate(images):
+            corners.append(self.get_corners_cached(i))
+            if job is not None:
+                job.step(0.5 * (n + 1) / len(images),"detecting")
         
         goodcorners = [(co,b) for (ok,co,b) in corners if ok]
         if not goodcorners:
             raise CalibrationException("No corners found in images!")
         return goodcorners
     
-    def cal_fromcorners(self,good):
+    def collect_corners_from_buffers(self,buffers,pool = None):
+        """
+        :param buffers: encoded images (PNG/PGM/JPEG bytes) containing chessboards
+        :type buffers: list of bytes
+        :param pool: optional executor used to decode and detect the images in parallel
+        
+        Find chessboards in all images.
+        
+        Return [(corners,ChessboardInfo)]
+        """
+        # the encoded file is hashed, so no decoding at all is needed on a cache hit
+        return self.collect_corners_parallel(buffers,get_corners_from_buffer,lambda buf : buf,pool)
+    
+    def collect_corners_parallel(self,items,detect,cache_data,pool = None):
+        """
+        :param items: picklable image sources
+        :param detect: picklable function, detect(item,boards,checkerboard_flags) returns (ok,corners,board,(width,height))
+        :param cache_data: cache_data(item) returns the image content hashed for the corner cache
+        :param pool: optional executor used to detect the images in parallel
+        
+        Find chessboards in all images, looking them up in the corner cache first.
+        
+        Return [(corners,ChessboardInfo)]
+        """
+        if not items:
+            raise CalibrationException("No images to calibrate from!")
+        
+        corners = [None] * len(items)
+        keys = [None] * len(items)
+        if self.corner_cache is not None:
+            for (i,item) in enumerate(items):
+                keys[i] = self.corner_cache.key(cache_data(item),self._boards,self.checkerboard_flags)
+                corners[i] = self.corner_cache.get(keys[i],self._boards)
+        missing = [i for i in range(len(items)) if corners[i] is None]
+        
+        args = ([items[i] for i in missing],itertools.repeat(self._boards),itertools.repeat(self.checkerboard_flags))
+        if pool is None:
+            detected = map(detect,*args)
+        else:
+            # the images are independent, so hand them out in chunks to keep the IPC overhead low
+            chunksize = max(1,len(missing) // (4 * (os.cpu_count() or 1)))
+            detected = pool.map(detect,*args,chunksize = chunksize)
+        for (i,result) in zip(missing,detected):
+            corners[i] = result
+            if self.corner_cache is not None:
+                self.corner_cache.put(keys[i],result,self._boards)
+                
+        self.size = corners[0][3]
+        goodcorners = [(co,b) for (ok,co,b,_) in corners if ok]
+        if not goodcorners:
+            raise CalibrationException("No corners found in images!")
+        return goodcorners
+    
+    def cal_fromcorners(self,good,job = None):
         """
         :param good: Good corner positions and boards
         :type good: [(corners,ChessboardInfo)]
+        :param job: optional CalibrationJob the progress is reported to, it may stop the calibration before
+            the solution is stored
+        
+        With --max_calib_samples K, only the K views picked by select_views are solved over. The selection,
+        the solve time and the reprojection error of the views left out are kept in selection_report. Its
+        heldout_gap is the left out views' error minus the selected views' error, both under the subset
+        solution : the accuracy cost against solving over all the views is only measured by
+        benchmarks/bench_pipeline, since it takes the full solve the selection avoids.
         """
+        selected = None
+        k = self.params.args.max_calib_samples
+        if k > 0 and len(good) > k:
+            start = time.perf_counter()
+            selected = self.select_views(good,k)
+            select_time = time.perf_counter() - start
+            heldout = [good[i] for i in sorted(set(range(len(good))) - set(selected))]
+            good = [good[i] for i in selected]
+            
         (ipts,boards) = zip(*good)
         opts = self.mk_object_points(boards)
         
-        # If FIX_ASPECT_RATIO flag is set, enforce focal lengths have 1/1 ratio
-        intrinsics_in = numpy.eye(3,dtype = numpy.float64)
-        
         if self.camera_model == CAMERA_MODEL.PINHOLE:
             # print("mono pinhole calibration ..")
             self.logger.info("######### Mono Pinhole Calibration #########")
-            reproj_err , self.intrinsics , dist_coeffs , rvecs , tvecs = cv2.calibrateCamera(
+        elif self.camera_model == CAMERA_MODEL.FISHEYE:
+            self.logger.info("######### Mono Fisheye Calibration #########")
+            
+        if job is not None:
+            job.step(0.5,"solving")
+        # start near the optimum when the live preview has an estimate
+        guess = self.warm_start()
+        start = time.perf_counter()
+        if self.params.args.robust_calibration:
+            (reproj_err,intrinsics,distortion) = self.robust_solve(opts,ipts,job,guess)
+            if selected is not None:
+                # ids of the views in good
+                self.robust_report["rejected"] = [selected[i] for i in self.robust_report["rejected"]]
+                self.robust_report["view_errors"] = {selected[i] : e for (i,e) in self.robust_report["view_errors"].items()}
+        else:
+            (reproj_err,intrinsics,distortion,_,_) = self.solve(opts,ipts,guess)
+        solve_time = time.perf_counter() - start
+        if job is not None:
+            job.step(0.95,"solving")
+        
+        self.selection_report = None
+        if selected is not None:
+            (heldout_ipts,heldout_boards) = zip(*heldout)
+            errors = self.heldout_errors(self.mk_object_points(heldout_boards),heldout_ipts,intrinsics,distortion)
+            heldout_rms = float(numpy.sqrt(numpy.mean(errors ** 2)))
+            self.selection_report = {
+                "selected" : selected,
+                "views" : len(selected) + len(heldout),
+                "select_ms" : round(1000.0 * select_time,3),
+                "solve_s" : round(solve_time,4),
+                "rms" : float(reproj_err),
+                "heldout_rms" : heldout_rms,
+                "heldout_gap" : heldout_rms - float(reproj_err)
+            }
+            self.logger.info("### calibrated from %d of %d views selected in %.1f ms , solved in %.3f s , rms %.3f px , views left out %.3f px ###" % (
+                len(selected),len(selected) + len(heldout),1000.0 * select_time,solve_time,reproj_err,heldout_rms))
+        (self.intrinsics,self.distortion) = (intrinsics,distortion)
+        self.reproj_err = float(reproj_err)
+            
+        # R is identity matrix for monocular calibration
+        self.R = numpy.eye(3,dtype = numpy.float64)
+        self.P = numpy.zeros((3,4),dtype = numpy.float64)
+        
+        self.set_alpha(0.0)
+        
+    def solve(self,opts,ipts,guess = None):
+        """
+        One calibration over the given views, started from guess = (intrinsics,distortion) if given.
+        Returns (reproj_err,intrinsics,distortion,rvecs,tvecs).
+        """
+        if self.camera_model == CAMERA_MODEL.PINHOLE:
+            if guess is None:
+                # If FIX_ASPECT_RATIO flag is set, enforce focal lengths have 1/1 ratio
+                (intrinsics_in,dist_in,flags) = (numpy.eye(3,dtype = numpy.float64),None,self.calib_flags)
+            else:
+                (intrinsics_in,dist_in,flags) = (guess[0].copy(),guess[1].copy(),self.calib_flags | cv2.CALIB_USE_INTRINSIC_GUESS)
+            reproj_err , intrinsics , dist_coeffs , rvecs , tvecs = cv2.calibrateCamera(
                 opts,
                 ipts,
                 self.size,
                 intrinsics_in,
-                None,
-                flags = self.calib_flags
+                dist_in,
+                flags = flags
             )
             # OpenCV returns more than 8 coefficients (the additional ones all zeros) when CALIB_RATIONAL_MODEL is set.
             # The extra ones include e.g. thin prism coefficients, which we are not interested in.
             if self.calib_flags & cv2.CALIB_RATIONAL_MODEL:
-                self.distortion = dist_coeffs.flat[:8].reshape(-1,1) # rational polynomial
+                distortion = dist_coeffs.flat[:8].reshape(-1,1) # rational polynomial
             else:
-                self.distortion = dist_coeffs.flat[:5].reshape(-1,1) # plumb bob
+                distortion = dist_coeffs.flat[:5].reshape(-1,1) # plumb bob
         elif self.camera_model == CAMERA_MODEL.FISHEYE:
-            self.logger.info("######### Mono Fisheye Calibration #########")
+            if guess is None:
+                (intrinsics_in,dist_in,flags) = (numpy.eye(3,dtype = numpy.float64),None,self.fisheye_calib_flags)
+            else:
+                (intrinsics_in,dist_in,flags) = (guess[0].copy(),guess[1].copy(),self.fisheye_calib_flags | cv2.fisheye.CALIB_USE_INTRINSIC_GUESS)
             # WARNING : cv2.fisheye.calibrate wants float64 points
-            ipts64 = numpy.asarray(ipts,dtype = numpy.float64)
-            ipts = ipts64
-            opts64 = numpy.asarray(opts,dtype = numpy.float64)
-            opts = opts64
-            reproj_err , self.intrinsics , self.distortion , rvecs , tvecs = cv2.fisheye.calibrate(
+            ipts = numpy.asarray(ipts,dtype = numpy.float64)
+            opts = numpy.asarray(opts,dtype = numpy.float64)
+            reproj_err , intrinsics , distortion , rvecs , tvecs = cv2.fisheye.calibrate(
                 opts,
                 ipts,
                 self.size,
                 intrinsics_in,
-                None,
-                flags = self.fisheye_calib_flags
+                dist_in,
+                flags = flags
             )
+        return (reproj_err,intrinsics,distortion,rvecs,tvecs)
+        
+    def view_errors(self,opts,ipts,intrinsics,distortion,rvecs,tvecs):
+        """
+        RMS reprojection error (px) of every view.
+        """
+        # all the views are projected in one call : their object points are moved into the camera frame first
+        counts = [len(o) for o in opts]
+        R = numpy.repeat(numpy.array([cv2.Rodrigues(numpy.asarray(r,dtype = numpy.float64))[0] for r in rvecs]),counts,axis = 0)
+        t = numpy.repeat(numpy.array([numpy.ravel(t) for t in tvecs],dtype = numpy.float64),counts,axis = 0)
+        X = numpy.einsum("nij,nj->ni",R,numpy.concatenate(opts).reshape(-1,3).astype(numpy.float64)) + t
+        zero = numpy.zeros((3,1),dtype = numpy.float64)
+        if self.camera_model == CAMERA_MODEL.FISHEYE:
+            (projected,_) = cv2.fisheye.projectPoints(X.reshape(-1,1,3),zero,zero,intrinsics,distortion)
+        else:
+            (projected,_) = cv2.projectPoints(X.reshape(-1,1,3),zero,zero,intrinsics,distortion)
+        sq = ((projected.reshape(-1,2) - numpy.concatenate(ipts).reshape(-1,2)) ** 2).sum(axis = 1)
+        offsets = numpy.cumsum([0] + counts[:-1])
+        return numpy.sqrt(numpy.add.reduceat(sq,offsets) / counts)
+        
+    def robust_solve(self,opts,ipts,job = None,guess = None):
+        """
+        Calibrate, drop the views reprojecting worse than --reproj_threshold px (or 3 times the median view
+        error if larger) and calibrate again from the previous estimate, until no view is dropped.
+        The rejected views (indices into opts/ipts), the iterations and the time of every solve are kept in
+        robust_report.
+        
+        Returns (reproj_err,intrinsics,distortion).
+        """
+        ids = list(range(len(ipts)))
+        rejected = []
+        solve_times = []
+        for iteration in range(1,self.params.args.robust_iterations + 1):
+            start = time.perf_counter()
+            (reproj_err,intrinsics,distortion,rvecs,tvecs) = self.solve([opts[i] for i in ids],[ipts[i] for i in ids],guess)
+            solve_times.append(time.perf_counter() - start)
+            if job is not None:
+                job.step(0.5 + 0.45 * iteration / self.params.args.robust_iterations)
+            errors = self.view_errors([opts[i] for i in ids],[ipts[i] for i in ids],intrinsics,distortion,rvecs,tvecs)
+            threshold = max(self.params.args.reproj_threshold,3.0 * float(numpy.median(errors)))
+            outliers = [j for (j,e) in enumerate(errors) if e > threshold]
+            self.logger.info("### robust calibration : solve %d over %d views in %.3f s , rms %.3f px , %d views above %.2f px ###" % (
+                iteration,len(ids),solve_times[-1],reproj_err,len(outliers),threshold))
+            if not outliers or len(ids) - len(outliers) < self.MIN_VIEWS:
+                break
+            if iteration == self.params.args.robust_iterations:
+                break
+            rejected += [ids[j] for j in outliers]
+            ids = [i for (j,i) in enumerate(ids) if j not in outliers]
+            guess = (intrinsics,distortion)
             
-        # R is identity matrix for monocular calibration
-        self.R = numpy.eye(3,dtype = numpy.float64)
-        self.P = numpy.zeros((3,4),dtype = numpy.float64)
+        self.robust_report = {
+            "iterations" : len(solve_times),
+            "solve_s" : [round(t,4) for t in solve_times],
+            "rejected" : rejected,
+            "reproj_err" : float(reproj_err),
+            "view_errors" : {i : round(float(e),4) for (i,e) in zip(ids,errors)}
+        }
+        if rejected:
+            self.logger.info("### robust calibration : rejected views %s ###" % rejected)
+        return (reproj_err,intrinsics,distortion)
+        
+    def select_views(self,good,k):
+        """
+        Indices (sorted) of k views of good spread over the sample space, to bound the cost of the solve :
+        farthest-point sampling in the get_parameters space, the distance of every candidate being weighted
+        by the share of its corners' COVERAGE_GRID cells not yet covered by the views already selected.
+        """
+        params = numpy.array([self.get_parameters(co,b,self.size) for (co,b) in good])
+        (w,h) = self.size
+        (gx,gy) = self.COVERAGE_GRID
+        cells = numpy.zeros((len(good),gx * gy),dtype = bool)
+        for (i,(co,_)) in enumerate(good):
+            xy = co.reshape(-1,2)
+            cx = numpy.clip((xy[:,0] * gx / w).astype(int),0,gx - 1)
+            cy = numpy.clip((xy[:,1] * gy / h).astype(int),0,gy - 1)
+            cells[i,cy * gx + cx] = True
+        counts = cells.sum(axis = 1)
+        
+        # start from the view covering the most of the image
+        first = int(numpy.argmax(counts))
+        selected = [first]
+        distance = numpy.linalg.norm(params - params[first],axis = 1)
+        covered = cells[first].copy()
+        for _ in range(k - 1):
+            new = (cells & ~covered).sum(axis = 1) / counts
+            score = distance * (1.0 + new)
+            score[selected] = -1.0
+            i = int(numpy.argmax(score))
+            selected.append(i)
+            distance = numpy.minimum(distance,numpy.linalg.norm(params - params[i],axis = 1))
+            covered |= cells[i]
+        return sorted(selected)
+    
+    def heldout_errors(self,opts,ipts,intrinsics,distortion):
+        """
+        RMS reprojection error (px) of every view left out of a calibration, posed with solvePnP.
+        """
+        rvecs = []
+        tvecs = []
+        for (o,i) in zip(opts,ipts):
+            if self.camera_model == CAMERA_MODEL.FISHEYE:
+                # posed in normalized coordinates
+                normalized = cv2.fisheye.undistortPoints(numpy.asarray(i,dtype = numpy.float64).reshape(-1,1,2),intrinsics,distortion)
+                (_,r,t) = cv2.solvePnP(o,normalized,numpy.eye(3),None)
+            else:
+                (_,r,t) = cv2.solvePnP(o,i,intrinsics,distortion)
+            rvecs.append(r)
+            tvecs.append(t)
+        return self.view_errors(opts,ipts,intrinsics,distortion,rvecs,tvecs)
+    
+    def set_cammodel(self,modeltype):
+        super(MonoCalibrator,self).set_cammodel(modeltype)
+        # the estimate of the other model is no starting point
+        self.estimate = None
+        self.converged = False
         
-        self.set_alpha(0.0)
+    def warm_start(self):
+        """
+        (intrinsics,distortion) of the live preview estimate, None if there is none.
+        """
+        estimate = self.estimate
+        if estimate is None or estimate["model"] != self.camera_model:
+            return None
+        return (estimate["intrinsics"],estimate["distortion"])
+    
+    def update_estimate(self,good):
+        """
+        Live preview : solve over the samples collected so far, warm-started from the previous estimate, without
+        touching the calibration. The estimate has converged once fx,fy,cx,cy change by less than CONVERGED_CHANGE
+        in two estimates in a row, which makes the calibrator goodenough.
         
+        Returns the estimate, None if the solve failed.
+        """
+        (ipts,boards) = zip(*good)
+        opts = self.mk_object_points(boards)
+        model = self.camera_model
+        previous = self.warm_start()
+        start = time.perf_counter()
+        try:
+            (reproj_err,intrinsics,distortion,_,_) = self.solve(opts,ipts,previous)
+        except cv2.error as e:
+            # e.g. too few or too similar views yet for the fisheye model
+            self.logger.warning("Live preview solve over %d samples failed : %s" % (len(good),str(e).strip().splitlines()[-1]))
+            return None
+        solve_time = time.perf_counter() - start
+        METRICS.observe("live_preview_solve",solve_time)
+        
+        change = None
+        settled = self.estimate is not None and self.estimate["change"] is not None and self.estimate["change"] < self.CONVERGED_CHANGE
+        if previous is not None:
+            (new,old) = (self.focal_center(intrinsics),self.focal_center(previous[0]))
+            change = float(numpy.max(numpy.abs(new - old) / numpy.abs(old)))
+        self.estimate = {
+            "model" : model,
+            "samples" : len(good),
+            "intrinsics" : intrinsics,
+            "distortion" : distortion,
+            "reproj_err" : float(reproj_err),
+            "change" : change,
+            "solve_s" : solve_time,
+            "converged" : settled and change < self.CONVERGED_CHANGE
+        }
+        self.logger.info("### live preview : %d samples , fx %.1f fy %.1f cx %.1f cy %.1f , rms %.3f px , change %s , solved in %.3f s ###" % (
+            (len(good),) + tuple(self.focal_center(intrinsics)) + (reproj_err,"%.4f" % change if change is not None else "-",solve_time)))
+        if self.estimate["converged"] and not self.converged:
+            self.logger.info("### live preview : estimate converged after %d samples ###" % len(good))
+            self.converged = True
+            if self._min_params is not None:
+                # update_goodenough picks up converged
+                self._goodenough_params = self.update_goodenough()
+        return self.estimate
+    
+    @staticmethod
+    def focal_center(intrinsics):
+        return numpy.array([intrinsics[0,0],intrinsics[1,1],intrinsics[0,2],intrinsics[1,2]])
+    
     def set_alpha(self,a):
         """
         Set the alpha value for the calibrated camera solution. The alpha value is a zoom, and ranges from 0
         (zoomed in, all pixels in calibrated image are valid) to 1 (zoomed out, all pixels in original image are in calibrated image).
         """
+        self.alpha = a
         
         if self.camera_model == CAMERA_MODEL.PINHOLE:
             # NOTE : Prior to Electric, this code was broken such that we never actually saved the new
@@ -111,13 +432,41 @@ class MonoCalibrator(Calibrator):
             for j in range(3):
                 for i in range(3):
                     self.P[j,i] = ncm[j,i]
-            self.mapx , self.mapy = cv2.initUndistortRectifyMap(self.intrinsics,self.distortion,self.R,ncm,self.size,cv2.CV_32FC1)
         elif self.camera_model == CAMERA_MODEL.FISHEYE:
             # NOTE : cv2.fisheye.estimateNewCameraMatrixForUndistortRectify not producing proper results, using a naive approach instead:
             self.P[:3,:3] = self.intrinsics[:3,:3]
             self.P[0,0] = (1. + a)
             self.P[1,1] = (1. + a)
-            self.mapx , self.mapy  = cv2.fisheye.initUndistortRectifyMap(self.intrinsics,self.distortion,self.R,self.P,self.size,cv2.CV_32FC1)
+            
+        # The live preview only needs the display (scrib) resolution, so its maps are computed directly at that size,
+        # in fixed-point format which remaps faster. The full resolution maps are only built when remap is used.
+        self.display_map1 , self.display_map2 = self.init_undistort_map(display_size(self.size),cv2.CV_16SC2)
+        self.mapx , self.mapy = None , None
+        
+    def init_undistort_map(self,size,m1type):
+        """
+        Undistortion maps producing an image of the given size, e.g. smaller than the calibrated image size.
+        The maps always point into the full resolution source image.
+        """
+        # P follows from the other inputs, so they are enough to identify the maps
+        key = self.map_cache.key(self.intrinsics,self.distortion,self.R,self.size,self.alpha,self.camera_model.name,size,m1type)
+        maps = self.map_cache.get(key)
+        if maps is not None:
+            return maps
+        
+        # scale the projection to the output size
+        P = self.P.copy()
+        P[0,:] *= float(size[0]) / self.size[0]
+        P[1,:] *= float(size[1]) / self.size[1]
+        if self.camera_model == CAMERA_MODEL.PINHOLE:
+            maps = cv2.initUndistortRectifyMap(self.intrinsics,self.distortion,self.R,P[:3,:3],size,m1type)
+        elif self.camera_model == CAMERA_MODEL.FISHEYE:
+            maps = cv2.fisheye.initUndistortRectifyMap(self.intrinsics,self.distortion,self.R,P,size,m1type)
+            
+        self.map_cache.put(key,maps,
+                           K = self.intrinsics,D = self.distortion,R = self.R,P = P,
+                           size = self.size,out_size = size,alpha = self.alpha,model = self.camera_model.name)
+        return maps
             
     def remap(self,src):
         """
@@ -126,8 +475,19 @@ class MonoCalibrator(Calibrator):
         
         Apply the post-calibration undistortion to the source iamge
         """
+        if self.mapx is None:
+            self.mapx , self.mapy = self.init_undistort_map(self.size,cv2.CV_32FC1)
         return cv2.remap(src,self.mapx,self.mapy,cv2.INTER_LINEAR)
     
+    def remap_display(self,src,size):
+        """
+        Apply the post-calibration undistortion to the full resolution source image, producing
+        the display image of the given size.
+        """
+        if self.display_map1.shape[:2] == (size[1],size[0]):
+            return cv2.remap(src,self.display_map1,self.display_map2,cv2.INTER_LINEAR)
+        return cv2.resize(self.remap(src),size)
+    
     def undistort_points(self,src):
         """
         :param src: N souce pixel points (u,v) as an Nx2 matrix
@@ -215,25 +575,36 @@ class MonoCalibrator(Calibrator):
         else:
             return None
             
-    def handle_msg(self,msg):
+    def handle_msg(self,msg,detection = None):
         """
         Detects the calibration target and, if found and provides enough new information, adds it to the sample database.
         
+        detection is the result of downsample_and_detect for msg, when it has already been computed
+        elsewhere (e.g. by a detection worker process).
+        
         Returns a MonoDrawable message with the display image and progress info.
         """
+        with METRICS.timer("handle_msg"):
+            return self._handle_msg(msg,detection)
         
+    def _handle_msg(self,msg,detection):
         gray = self.mkgray(msg)
         linear_error = -1
         
         # Get display-image-to-be (scrib) and detection of the calibration target.
-        scrib_mono , corners , downsampled_corners , board , (x_scale,y_scale) = self.downsample_and_detect(gray)
+        if detection is None:
+            reason = self.gate_frame(gray)
+            if reason is None:
+                detection = self.downsample_and_detect(gray)
+            else:
+                detection = self.gated_detection(gray,reason)
+        self.last_detection = detection
+        scrib_mono , corners , downsampled_corners , board , (x_scale,y_scale) = detection
         
         if self.calibrated:
             # Show rectified image
-            gray_remap = self.remap(gray)
-            gray_rect = gray_remap
-            if x_scale != 1.0 or y_scale != 1.0:
-                gray_rect = cv2.resize(gray_remap,(scrib_mono.shape[1],scrib_mono.shape[0]))
+            with METRICS.timer("remap"):
+                gray_rect = self.remap_display(gray,(scrib_mono.shape[1],scrib_mono.shape[0]))
                 
             scrib = cv2.cvtColor(gray_rect,cv2.COLOR_GRAY2BGR)
             
@@ -246,19 +617,22 @@ class MonoCalibrator(Calibrator):
                 scrib_src = undistorted.copy()
                 scrib_src[:,:,0] /= x_scale
                 scrib_src[:,:,1] /= y_scale
-                cv2.drawChessboardCorners(scrib,(board.n_cols,board.n_rows),scrib_src,True)
+                with METRICS.timer("draw_corners"):
+                    cv2.drawChessboardCorners(scrib,(board.n_cols,board.n_rows),scrib_src,True)
                 
         else:
             scrib = cv2.cvtColor(scrib_mono,cv2.COLOR_GRAY2BGR)
             if corners is not None:
                 # Draw (potentially downsampled) corners onto display image
-                cv2.drawChessboardCorners(scrib,(board.n_cols,board.n_rows),downsampled_corners,True)
+                with METRICS.timer("draw_corners"):
+                    cv2.drawChessboardCorners(scrib,(board.n_cols,board.n_rows),downsampled_corners,True)
             
                 # Add sample to database only if it's sufficiently different from any previous sample.
                 params = self.get_parameters(corners,board,(gray.shape[1],gray.shape[0]))
-                if self.is_good_sample(params,corners,self.last_frame_corners):
-                    self.db.append((params,gray))
-                    self.good_corners.append((corners,board))
+                with METRICS.timer("is_good_sample"):
+                    good = self.is_good_sample(params,corners,self.last_frame_corners)
+                if good:
+                    self.add_sample(params,gray,corners,board)
                     self.logger.info("### Added sample %d , p_x = %.3f , p_y = %.3f , p_size = %.3f , skew = %.3f ###"%tuple([len(self.db)]+params))
                 
         self.last_frame_corners = corners
@@ -270,18 +644,26 @@ class MonoCalibrator(Calibrator):
         
         return rv
     
-    def do_calibration(self,dump = False):
-        if not self.good_corners:
+    def do_calibration(self,dump = False,job = None):
+        """
+        Calibrate from the samples collected so far. With a CalibrationJob, samples may still be added while
+        calibrating : the calibration uses those there were when it started.
+        """
+        good_corners = list(self.good_corners)
+        if not good_corners:
             self.logger.info("******** Collecting corners for all images! ************")
-            images = [i for (p,i) in self.db]
-            self.good_corners = self.collect_corners(images)
-        self.size = (self.db[0][1].shape[1],self.db[0][1].shape[0])
+            images = [self.sample_store.get(i) for (p,i) in list(self.db)]
+            good_corners = self.good_corners = self.collect_corners(images,job)
         # Dump should only occur if user wants it
         if dump:
-            pickle.dump((self.is_mono,self.size,self.good_corners),
+            pickle.dump((self.is_mono,self.size,good_corners),
                         open("/tmp/camera_calibration_%08x.pickle"%random.getrandbits(32),"w"))
-        self.cal_fromcorners(self.good_corners)
+        self.cal_fromcorners(good_corners,job)
         self.calibrated = True
+        if self.roi_tracking:
+            self.logger.info("### ROI tracking : hit rate %.2f , detection time saved %.2f s ###" % self.tracking_report())
+        if self.frame_gate is not None:
+            self.logger.info("### Frame gate : %d detected , skipped %s ###" % (self.frame_gate.passed,self.frame_gate.skipped))
         # DEBUG
         print((self.report()))
         print((self.ost()))
@@ -297,22 +679,68 @@ class MonoCalibrator(Calibrator):
             else:
                 s = BytesIO(buf)
                 
-            ti = tarfile.Tarinfo(name)
+            ti = tarfile.TarInfo(name)
             ti.size = len(s.getvalue())
             ti.uname = "calibrator"
             ti.mtime = int(time.time())
             tf.addfile(tarinfo = ti,fileobj = s)
             
-        ims = [("left-%04d.png" % i , im) for i,(_,im) in enumerate(self.db)]
-        
-        for (name,im) in ims:
-            taradd(name,cv2.imencode(".png",im)[1].tostring())
+        if self.sample_store.retains_images:
+            ims = [("left-%04d.png" % i , im) for i,(_,im) in enumerate(self.db)]
+            
+            for (name,im) in ims:
+                taradd(name,self.sample_store.encode(im,".png"))
+        else:
+            self.logger.warning("Sample images were not retained, only the calibration is saved")
         taradd("ost.yaml",self.yaml())
         taradd("ost.txt",self.ost())
         
-    def do_tarfile_calibration(self,filename):
-        archive = tarfile.open(filename,"r")
+    def do_tarfile_calibration(self,filename,pool = None):
+        """
+        Calibrate from the images of a tarfile written by do_tarfile_save.
+        """
+        with tarfile.open(filename,"r") as archive:
+            buffers = [archive.extractfile(f).read() for f in sorted(archive.getnames()) if (f.startswith("left") and (f.endswith(".pgm") or f.endswith(".png")))]
+            
+        self.good_corners = self.collect_corners_from_buffers(buffers,pool)
+        self.cal_fromcorners(self.good_corners)
+        self.calibrated = True
+        
+    def do_directory_calibration(self,dirname,pool = None):
+        """
+        Calibrate from the images (PNG/PGM/JPEG) found in a directory.
+        """
+        buffers = []
+        for f in sorted(os.listdir(dirname)):
+            if os.path.splitext(f)[1].lower() in (".png",".pgm",".jpg",".jpeg"):
+                with open(os.path.join(dirname,f),"rb") as im:
+                    buffers.append(im.read())
+                    
+        self.good_corners = self.collect_corners_from_buffers(buffers,pool)
+        self.cal_fromcorners(self.good_corners)
+        self.calibrated = True
         
-        images = [image_from_archive(archive,f) for f in archive.getname() if (f.startswith("left") and (f.endswith(".pgm") or f.endswith("png")))]
+    def do_spool_calibration(self,dirname,pool = None):
+        """
+        Calibrate from the sample spool of a (possibly crashed) session recorded with --sample_storage spool.
+        """
+        (spool,count) = SpoolSampleStore.load(dirname)
+        # workers map the spool file themselves, only the sample ids are sent to them
+        detect = functools.partial(get_corners_from_spool,os.path.join(dirname,SpoolSampleStore.SPOOL_FILE))
+        self.good_corners = self.collect_corners_parallel(list(range(count)),detect,lambda i : CornerCache.image_data(spool[i]),pool)
+        self.cal_fromcorners(self.good_corners)
+        self.calibrated = True
         
-        self.cal(images)
\ No newline at end of file
+    def as_dict(self):
+        """
+        Calibration result in the form stored by the web app and the batch calibration.
+        """
+        return {
+            "model" : self.camera_model.name,
+            "img_w" : self.size[0],
+            "img_h" : self.size[1],
+            "D" : numpy.ravel(self.distortion).tolist(),
+            "K" : numpy.ravel(self.intrinsics).tolist(),
+            "R" : numpy.ravel(self.R).tolist(),
+            "P" : numpy.ravel(self.P).tolist()
+        }
@@ -0,0 +1,48 @@
+from CalibrationNode import *
+from FrameSource import open_source
+from params import Params
+
+import json
+
+
+class Replayer(Params):
+    """
+    Headless calibration session fed by a recording instead of a camera, through the same queues and
+    consumer threads as a live session, reporting the end-to-end frame rate and the samples accepted.
+    """
+    
+    def __init__(self):
+        
+        Params.__init__(self)
+        
+        self.logger = CalibLogger().get_logger()
+        
+        self.boards = [ChessboardInfo(self.args.chessboard_w,self.args.chessboard_h,self.args.chessboard_sqr_size)]
+        
+    def run(self):
+        if not self.args.replay_input:
+            self.logger.error("Nothing to replay, give a recording with --replay_input")
+            return None
+        
+        source = open_source(self.args.replay_input,self.args.replay_rate,self.args.replay_fps)
+        
+        start = time.perf_counter()
+        node = CalibrationNode(self.boards,
+                               checkerboard_flags = cv2.CALIB_CB_FAST_CHECK,
+                               queue_size = 1,
+                               detection_workers = self.args.detection_workers,
+                               source = source)
+        node.drain()
+        elapsed = time.perf_counter() - start
+        
+        stats = node.stats()
+        stats["wall_time_s"] = round(elapsed,3)
+        stats["goodenough"] = node.c.goodenough if node.c is not None else False
+        node.release()
+        
+        self.logger.info("########## replayed %d frames of %s in %.2f s : %s fps end to end , %d dropped , %d samples accepted ##########" % (
+            stats["frames"],self.args.replay_input,elapsed,stats.get("end_to_end_fps","-"),stats["calibrator_dropped_frames"],stats["samples_accepted"]))
+        if self.args.replay_report:
+            with open(self.args.replay_report,"w") as f:
+                json.dump(stats,f,indent = 2)
+        return stats
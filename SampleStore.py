@@ -0,0 +1,170 @@
+from utils import *
+
+import os
+import json
+import tempfile
+
+
+class SampleStore():
+    """
+    Keeps the images of the samples in the calibration database. self.db holds whatever put returns
+    for an image, and get turns it back into the grayscale image.
+    
+    This base store keeps the full image in memory.
+    """
+    retains_images = True
+    
+    def put(self,img):
+        return img
+    
+    def get(self,ref):
+        return ref
+    
+    def encode(self,ref,ext = ".png"):
+        """
+        Returns the image as encoded bytes, e.g. for the tarfile export.
+        """
+        return cv2.imencode(ext,self.get(ref))[1].tobytes()
+    
+    
+class NullSampleStore(SampleStore):
+    """
+    Drops the images, the samples only keep their parameters and corners.
+    """
+    retains_images = False
+    
+    def put(self,img):
+        return None
+    
+    def get(self,ref):
+        raise CalibrationException("Sample images are not retained (--sample_storage none)")
+    
+    
+class EncodedSampleStore(SampleStore):
+    """
+    Keeps the images in memory as compressed PNG or JPEG bytes.
+    """
+    
+    def __init__(self,ext = ".png",jpeg_quality = 95):
+        self.ext = ext
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY,jpeg_quality] if ext == ".jpg" else []
+        
+    def put(self,img):
+        return cv2.imencode(self.ext,img,self.encode_params)[1].tobytes()
+    
+    def get(self,ref):
+        return cv2.imdecode(numpy.frombuffer(ref,numpy.uint8),cv2.IMREAD_GRAYSCALE)
+    
+    def encode(self,ref,ext = ".png"):
+        if ext == self.ext:
+            return ref
+        return SampleStore.encode(self,ref,ext)
+    
+    
+class DiskSampleStore(SampleStore):
+    """
+    Spills the images to PNG files in a directory of its own, created under sample_dir.
+    """
+    
+    def __init__(self,sample_dir):
+        os.makedirs(sample_dir,exist_ok = True)
+        self.dir = tempfile.mkdtemp(prefix = "session-",dir = sample_dir)
+        self.count = 0
+        
+    def put(self,img):
+        path = os.path.join(self.dir,"left-%04d.png" % self.count)
+        if not cv2.imwrite(path,img):
+            raise CalibrationException("Could not write sample image %s" % path)
+        self.count += 1
+        return path
+    
+    def get(self,ref):
+        return cv2.imread(ref,cv2.IMREAD_GRAYSCALE)
+    
+    def encode(self,ref,ext = ".png"):
+        if ext == ".png":
+            with open(ref,"rb") as f:
+                return f.read()
+        return SampleStore.encode(self,ref,ext)
+    
+    
+class SpoolSampleStore(SampleStore):
+    """
+    Writes the images into a preallocated memory-mapped .npy file of fixed frame shape, indexed by sample id.
+    The database references the samples by id and get returns a view into the file, so images are never
+    held in RAM or copied. The number of valid samples is kept next to the spool, which makes it
+    usable for offline calibration (MonoCalibrator.do_spool_calibration) even after a crash.
+    """
+    SPOOL_FILE = "spool.npy"
+    INFO_FILE = "spool.json"
+    
+    def __init__(self,sample_dir,capacity = 64):
+        os.makedirs(sample_dir,exist_ok = True)
+        self.dir = tempfile.mkdtemp(prefix = "spool-",dir = sample_dir)
+        self.capacity = capacity
+        self.count = 0
+        self.spool = None
+        
+    def put(self,img):
+        if self.spool is None:
+            # frame shape is only known with the first sample
+            self.allocate(self.capacity,img.shape,img.dtype)
+        elif img.shape != self.spool.shape[1:]:
+            raise CalibrationException("Sample of shape %s does not fit spool of shape %s" % (img.shape,self.spool.shape[1:]))
+        elif self.count == self.capacity:
+            self.allocate(2 * self.capacity,img.shape,img.dtype)
+            
+        self.spool[self.count] = img
+        self.spool.flush()
+        self.count += 1
+        self.write_info()
+        return self.count - 1
+    
+    def get(self,ref):
+        return self.spool[ref]
+    
+    def allocate(self,capacity,shape,dtype):
+        path = os.path.join(self.dir,self.SPOOL_FILE)
+        tmp = path + ".tmp"
+        spool = numpy.lib.format.open_memmap(tmp,mode = "w+",dtype = dtype,shape = (capacity,) + tuple(shape))
+        if self.spool is not None:
+            # grow : copy what was spooled so far into the larger file
+            spool[:self.count] = self.spool[:self.count]
+            spool.flush()
+        os.replace(tmp,path)
+        self.spool = spool
+        self.capacity = capacity
+        
+    def write_info(self):
+        path = os.path.join(self.dir,self.INFO_FILE)
+        with open(path + ".tmp","w") as f:
+            json.dump({"count" : self.count,"shape" : list(self.spool.shape[1:])},f)
+        os.replace(path + ".tmp",path)
+        
+    @classmethod
+    def load(cls,dirname):
+        """
+        Open a spool read-only. Returns (spool,count)
+        """
+        with open(os.path.join(dirname,cls.INFO_FILE),"r") as f:
+            count = json.load(f)["count"]
+        spool = numpy.load(os.path.join(dirname,cls.SPOOL_FILE),mmap_mode = "r")
+        return (spool,min(count,spool.shape[0]))
+    
+    
+def make_sample_store(args):
+    """
+    Sample store selected by --sample_storage.
+    """
+    if args.sample_storage == "none":
+        return NullSampleStore()
+    elif args.sample_storage == "png":
+        return EncodedSampleStore(".png")
+    elif args.sample_storage == "jpeg":
+        return EncodedSampleStore(".jpg",args.jpeg_quality)
+    elif args.sample_storage == "disk":
+        return DiskSampleStore(args.sample_dir)
+    elif args.sample_storage == "spool":
+        # room for twice the samples needed for calibration before the spool has to grow
+        return SpoolSampleStore(args.sample_dir,2 * args.sample_count)
+    return SampleStore()
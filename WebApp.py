@@ -1,5 +1,5 @@
 import numpy as np
-from flask import Flask , render_template , request , jsonify , url_for , Response , redirect
+from flask import Flask , render_template , request , jsonify , url_for , Response , redirect , send_file
 import json
 import re
 import pickle
@@ -9,57 +9,137 @@ import signal
 
 from CamContext import *
 from CalibrationNode import *
+from FrameBroadcaster import FrameBroadcaster
 from params import Params
+from metrics import METRICS
+from profiler import PROFILER
 
 
 class SeeCamCalibrationNode():
+    """
+    Holds one calibration session (OpenCVCalibrationNode + MonoCalibrator) per camera serial number,
+    so that all the cameras of a bot can be calibrated at the same time.
+    """
     
-    def __init__(self,chessboard_w,chessboard_h,chessboard_sqr_size,img_w,img_h):
-        self.node = None
+    def __init__(self,chessboard_w,chessboard_h,chessboard_sqr_size,img_w,img_h,detection_workers = 0,fourcc = "MJPG",fps = 30,capture_buffers = 2):
+        # serial number -> OpenCVCalibrationNode
+        self.nodes = dict()
+        # serial number -> FrameBroadcaster of the session's display
+        self.broadcasters = dict()
+        # job id -> CalibrationJob, of all the sessions
+        self.jobs = dict()
+        self._lock = threading.Lock()
         self._chessboard_w = chessboard_w
         self._chessboard_h = chessboard_h
         self._chessboard_sqr_size = chessboard_sqr_size
         self._img_w = img_w
         self._img_h = img_h
+        self._detection_workers = detection_workers
+        self._fourcc = fourcc
+        self._fps = fps
+        self._capture_buffers = capture_buffers
         
         
-    def initialize_calibration_node(self,cam_index):
-        if self.node is not None:
-            self.reset_calibration_node()
+    def initialize_calibration_node(self,serial_number,cam_index):
+        # restart the session if this camera is already being calibrated
+        self.reset_calibration_node(serial_number)
         
-        if self.node is None:
-            boards = [ChessboardInfo(self._chessboard_w,self._chessboard_h,self._chessboard_sqr_size)]
-            calib_flags = 0
-            fisheye_calib_flags = 0
-            checkerboard_flags = cv2.CALIB_CB_FAST_CHECK
+        boards = [ChessboardInfo(self._chessboard_w,self._chessboard_h,self._chessboard_sqr_size)]
+        calib_flags = 0
+        fisheye_calib_flags = 0
+        checkerboard_flags = cv2.CALIB_CB_FAST_CHECK
+        
+        node = OpenCVCalibrationNode(boards,
+                                    calib_flags,
+                                    fisheye_calib_flags,
+                                    checkerboard_flags = checkerboard_flags,
+                                    max_chessboard_speed = -1.0,
+                                    queue_size = 1,
+                                    cam_index = cam_index,
+                                    img_w = self._img_w,
+                                    img_h = self._img_h,
+                                    detection_workers = self._detection_workers,
+                                    fourcc = self._fourcc,
+                                    fps = self._fps,
+                                    capture_buffers = self._capture_buffers,
+                                    camera = serial_number,
+                                    overlay = False)
+        
+        broadcaster = FrameBroadcaster(node.queue_display,serial_number)
+        broadcaster.start()
+        
+        with self._lock:
+            self.nodes[serial_number] = node
+            self.broadcasters[serial_number] = broadcaster
             
-            self.node = OpenCVCalibrationNode(boards,
-                                        calib_flags,
-                                        fisheye_calib_flags,
-                                        checkerboard_flags = checkerboard_flags,
-                                        max_chessboard_speed = -1.0,
-                                        queue_size = 1,
-                                        cam_index = cam_index,
-                                        img_w = self._img_w,
-                                        img_h = self._img_h)
+        return node
             
-    def generate_frames(self):
-        try:
-            if self.node is not None:
-                while True:
-                    if self.node.queue_display.qsize() > 0:
-                        frame = self.node.queue_display.get()
-                        ret, buffer = cv2.imencode('.jpg', frame)
-                        if not ret:
-                            continue
-                        frame = buffer.tobytes()
-                        yield (b'--frame\r\n'
-                            b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        except AttributeError:
-            pass
+    def get_node(self,serial_number):
+        with self._lock:
+            return self.nodes.get(serial_number)
+            
+    def generate_frames(self,serial_number,quality = 95,max_fps = 0,scale = 1.0,adaptive = False):
+        with self._lock:
+            broadcaster = self.broadcasters.get(serial_number)
+        if broadcaster is None:
+            return
+        # every client gets the frames encoded once by the session's broadcaster
+        for frame in broadcaster.frames(quality,max_fps,scale,adaptive):
+            yield (b'--frame\r\n'
+                b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
+                    
+    def generate_events(self,serial_number):
+        node = self.get_node(serial_number)
+        if node is None:
+            return
+        # server-sent events, one per change of the session state
+        for state in node.progress.updates():
+            if state is None:
+                # keep-alive comment, fails once the client is gone
+                yield ": keepalive\n\n"
+            else:
+                yield "data: %s\n\n" % json.dumps(state)
+                    
+    def start_calibration(self,serial_number,timeout = 0):
+        """
+        Start the calibration job of a session, None if the session can't be calibrated now.
+        """
+        node = self.get_node(serial_number)
+        if node is None:
+            return None
+        job = node.calibrate(timeout)
+        if job is not None:
+            with self._lock:
+                self.jobs[job.id] = job
+        return job
+    
+    def get_job(self,job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+        
+    def stats(self):
+        with self._lock:
+            nodes = dict(self.nodes)
+        return {serial_number : node.stats() for serial_number , node in nodes.items()}
+    
+    def stream_stats(self,serial_number):
+        with self._lock:
+            broadcaster = self.broadcasters.get(serial_number)
+        if broadcaster is None:
+            return None
+        return broadcaster.stats()
                     
-    def reset_calibration_node(self):
-        self.node = None
+    def reset_calibration_node(self,serial_number):
+        with self._lock:
+            node = self.nodes.pop(serial_number,None)
+            broadcaster = self.broadcasters.pop(serial_number,None)
+            
+        # ends the streams of the clients still watching
+        if broadcaster is not None:
+            broadcaster.stop()
+        # release the camera so that it can be opened again
+        if node is not None:
+            node.release()
 
 
 class WebApp(CamContext,Params):
@@ -89,25 +169,22 @@ class WebApp(CamContext,Params):
         # variable to keep track and update table
         self.data = self.update_cam_details()
         
-        self.calib_node = SeeCamCalibrationNode(self.args.chessboard_w,self.args.chessboard_h,self.args.chessboard_sqr_size,self.img_w,self.img_h)
+        self.calib_node = SeeCamCalibrationNode(self.args.chessboard_w,self.args.chessboard_h,self.args.chessboard_sqr_size,self.img_w,self.img_h,self.args.detection_workers,
+                                                self.args.fourcc,self.args.fps,self.args.capture_buffers)
         
         self.calibrated = None
         
-        ##### coordinates of CALIBRATE button #######
-        self.CALIBRATE_BUTTON_X_MIN = 693
-        self.CALIBRATE_BUTTON_X_MAX = 799
-        self.CALIBRATE_BUTTON_Y_MIN = 305
-        self.CALIBRATE_BUTTON_Y_MAX = 411
-        
-        ##### coordinate to next or exit button ####
-        self.NEXT_OR_EXIT_BUTTON_X_MIN = 693
-        self.NEXT_OR_EXIT_BUTTON_X_MAX = 799
-        self.NEXT_OR_EXIT_BUTTON_Y_MIN = 414 
-        self.NEXT_OR_EXIT_BUTTON_Y_MAX = 516
+        # per-stage latency summary in the log
+        METRICS.start_logging(self.args.metrics_log_interval)
         
+        # CALIB_PROFILE=<seconds> profiles the start of the session
+        PROFILER.out_dir = self.args.profile_dir
+        PROFILER.start_from_env()
         
         ##### calibration result #####
         self.calibration_result = dict()
+        # sessions of different cameras finish concurrently
+        self._result_lock = threading.Lock()
         
     def update_cam_details(self):
         """
@@ -164,7 +241,7 @@ class WebApp(CamContext,Params):
                     
                     see_cam = {cam.serial_number : cam.camera_index for cam in self.get_seecam()}
                     
-                    self.calib_node.initialize_calibration_node(see_cam[row_data["SerialNumber"]])
+                    self.calib_node.initialize_calibration_node(serial_number,see_cam[serial_number])
                     
                     
                     row_data["processed"] = True
@@ -178,54 +255,145 @@ class WebApp(CamContext,Params):
                 return jsonify({"message":f"Error during processing : {str(e)}"}) , 500
             
     
-        @self.app.route("/video_feed")
-        def video_feed():
-            return Response(self.calib_node.generate_frames(),
+        @self.app.route("/video_feed/<serial_number>")
+        def video_feed(serial_number):
+            """
+            Preview stream, e.g. /video_feed/<serial_number>?quality=60&max_fps=10&scale=0.5&adaptive=1
+            """
+            quality = request.args.get("quality",self.args.stream_quality,type = int)
+            max_fps = request.args.get("max_fps",self.args.stream_max_fps,type = float)
+            scale = request.args.get("scale",self.args.stream_scale,type = float)
+            adaptive = request.args.get("adaptive",str(int(self.args.stream_adaptive))) in ["1","true","yes"]
+            return Response(self.calib_node.generate_frames(serial_number,quality,max_fps,scale,adaptive),
                             mimetype='multipart/x-mixed-replace; boundary=frame')
             
-        @self.app.route('/process_click', methods=['POST'])
-        def process_click():
-            data_json = request.get_json()
-            serial_number = data_json.get("SerialNumber")
+        @self.app.route("/stream_stats/<serial_number>")
+        def stream_stats(serial_number):
+            """
+            Encoding time and, per client, quality, frame rate and bytes/sec of the preview stream.
+            """
+            stats = self.calib_node.stream_stats(serial_number)
+            if stats is None:
+                return jsonify({"message":"Serial Number not being calibrated."}),404
+            return jsonify(stats)
+            
+        @self.app.route("/events/<serial_number>")
+        def events(serial_number):
+            """
+            Event stream of the session state : progress of every calibration parameter, sample count,
+            linear error and collecting/ready/calibrating/calibrated.
+            """
+            return Response(self.calib_node.generate_events(serial_number),
+                            mimetype = "text/event-stream",
+                            headers = {"Cache-Control" : "no-cache"})
+            
+        @self.app.route("/calibrate",methods = ["POST"])
+        def calibrate():
+            serial_number = request.get_json().get("SerialNumber")
+            
+            node = self.calib_node.get_node(serial_number)
+            if node is None:
+                return jsonify({"message":"Serial Number not being calibrated."}),404
+            
+            # the solve runs in the background, its progress is polled on /jobs/<job_id> or pushed on /events
+            job = self.calib_node.start_calibration(serial_number,self.args.calibration_timeout)
+            if job is None:
+                return jsonify({"message":"Not enough samples to calibrate, or already calibrating."}),409
+            return jsonify({"message":"Calibrating.","job":job.as_dict()}),202
         
-            x = data_json.get("x")
-            y = data_json.get("y")
+        @self.app.route("/jobs/<job_id>")
+        def job_status(job_id):
+            """
+            Status and progress of a calibration job.
+            """
+            job = self.calib_node.get_job(job_id)
+            if job is None:
+                return jsonify({"message":"No such job."}),404
+            return jsonify(job.as_dict())
+        
+        @self.app.route("/jobs/<job_id>/cancel",methods = ["POST"])
+        def cancel_job(job_id):
+            job = self.calib_node.get_job(job_id)
+            if job is None:
+                return jsonify({"message":"No such job."}),404
+            if not job.cancel():
+                return jsonify({"message":"Job already ended.","job":job.as_dict()}),409
+            return jsonify({"message":"Cancelling.","job":job.as_dict()}),202
+        
+        @self.app.route("/next",methods = ["POST"])
+        def next_camera():
+            serial_number = request.get_json().get("SerialNumber")
             
-            # print(f"Mouse Click at X : {x} , y : {y}")
+            node = self.calib_node.get_node(serial_number)
+            if node is None:
+                return jsonify({"message":"Serial Number not being calibrated."}),404
+            if node.c is None or not node.c.calibrated:
+                return jsonify({"message":"Camera not calibrated yet."}),409
             
-            if self.CALIBRATE_BUTTON_X_MIN <= x <= self.CALIBRATE_BUTTON_X_MAX and self.CALIBRATE_BUTTON_Y_MIN <= y <= self.CALIBRATE_BUTTON_Y_MAX:
-                if not self.calib_node.node.c.calibrated:
-                    self.calib_node.node.on_mouse(x,y)
-            elif self.NEXT_OR_EXIT_BUTTON_X_MIN <= x <= self.NEXT_OR_EXIT_BUTTON_X_MAX and self.NEXT_OR_EXIT_BUTTON_Y_MIN <= y <= self.NEXT_OR_EXIT_BUTTON_Y_MAX:
-                if self.calib_node.node.c.calibrated:
-                    # release the opened camera
-                    self.calib_node.node.release()
-                    
-                    # store the calibration result to save offline 
-                    self.calibration_result.update({
-                        serial_number : {
-                            "model" : self.calib_node.node.c.camera_model.name,
-                            "img_w" : self.calib_node.node.c.size[0],
-                            "img_h" : self.calib_node.node.c.size[1],
-                            "D" : np.ravel(self.calib_node.node.c.distortion).tolist(),
-                            "K" : np.ravel(self.calib_node.node.c.intrinsics).tolist(),
-                            "R" : np.ravel(self.calib_node.node.c.R).tolist(),
-                            "P" : np.ravel(self.calib_node.node.c.P).tolist()
-                        }
-                    })
-                    
-                    for row in self.data:
-                        if row["SerialNumber"] == serial_number:
-                            row["processed"] = True
-                            self.calibrated = True
-                            break
-                    # Rediredct to the main tabel view
-                    return redirect(url_for('home'))
-                
-                
+            # release the opened camera and end this camera's session
+            self.calib_node.reset_calibration_node(serial_number)
+            
+            # store the calibration result to save offline 
+            with self._result_lock:
+                self.calibration_result.update({
+                    serial_number : node.c.as_dict()
+                })
             
-            # If click is outside the target area, do nothing
-            return jsonify({"message": "Click outside target area"}), 200
+                for row in self.data:
+                    if row["SerialNumber"] == serial_number:
+                        row["processed"] = True
+                        self.calibrated = True
+                        break
+                    
+            return jsonify({"message":"Calibration result stored."}),200
+        
+        @self.app.route("/metrics")
+        def metrics():
+            """
+            Per-stage latency histograms and dropped frame counters, in the Prometheus text format.
+            """
+            return Response(METRICS.render(),mimetype = "text/plain; version=0.0.4")
+        
+        @self.app.route("/profile",methods = ["POST"])
+        def profile():
+            """
+            Start profiling all threads in the background for ?seconds=N (default 10, at most
+            Profiler.MAX_SECONDS), sampling every ?interval_ms (default 5). The result is polled on
+            /profile/result and downloaded from /profile/prof and /profile/trace.
+            """
+            seconds = min(request.args.get("seconds",10.0,type = float),PROFILER.MAX_SECONDS)
+            interval = request.args.get("interval_ms",5.0,type = float) / 1000.0
+            if not PROFILER.start(seconds,interval):
+                return jsonify({"message":"A profiling session is already running."}),409
+            return jsonify({"message":"Profiling.","seconds":seconds,"result":url_for("profile_result")}),202
+        
+        @self.app.route("/profile/result")
+        def profile_result():
+            """
+            Samples, duration and file paths of the last profile, 202 while it is still running.
+            """
+            if PROFILER.active:
+                return jsonify({"message":"Profiling in progress."}),202
+            if PROFILER.result is None:
+                return jsonify({"message":"No profile recorded yet."}),404
+            return jsonify(dict(PROFILER.result,profile_url = url_for("profile_file",kind = "prof"),trace_url = url_for("profile_file",kind = "trace")))
+        
+        @self.app.route("/profile/<kind>")
+        def profile_file(kind):
+            """
+            Download the .prof stats (kind prof) or the Chrome trace (kind trace) of the last profile.
+            """
+            result = PROFILER.result
+            if kind not in ("prof","trace") or PROFILER.active or result is None:
+                return jsonify({"message":"No such profile."}),404
+            return send_file(result["profile" if kind == "prof" else "trace"],as_attachment = True)
+        
+        @self.app.route("/capture_stats")
+        def capture_stats():
+            """
+            Measured fps, read latency and dropped frames of every camera being calibrated.
+            """
+            return jsonify(self.calib_node.stats())
         
         @self.app.route("/shutdown",methods = ["POST"])
         def shutdown():
@@ -243,7 +411,7 @@ class WebApp(CamContext,Params):
         
         file_name = f"{socket.gethostname()}.pkl"
         
-        with open(file_name,"wb") as res:
+        with self._result_lock, open(file_name,"wb") as res:
             pickle.dump(self.calibration_result,res)
             
         self.logger.info(f"============ Calibration Result Saved as {file_name}.pkl ============")
@@ -0,0 +1,6 @@
+from BatchCalibrator import *
+
+if __name__ == "__main__":
+    
+    BatchObj = BatchCalibrator()
+    BatchObj.run()
@@ -0,0 +1,6 @@
+"""
+Benchmarks of the calibration pipeline. Run from the repository root, e.g.
+
+    python -m benchmarks.bench_sample_index
+    python -m benchmarks.bench_pipeline --output benchmark_report.json
+"""
@@ -0,0 +1,329 @@
+"""
+Benchmark of the calibration pipeline on synthetic checkerboard images rendered under known pinhole and
+equidistant fisheye intrinsics, at every camera resolution of Params.cam_resolution :
+
+- get_corners (full resolution) and downsample_and_detect throughput, detection rate and corner accuracy
+- MonoCalibrator.handle_msg frames/sec and accepted samples
+- cal_fromcorners solve time vs sample count, and accuracy of the recovered intrinsics
+- --max_calib_samples view selection : selection and solve time, and accuracy vs the solve over all the views
+
+The results are written to a JSON report. Given the report of a previous run with --baseline, the run fails
+(exit status 1) when a timing got slower or an error larger by more than --tolerance.
+
+    python -m benchmarks.bench_pipeline --output report.json
+    python -m benchmarks.bench_pipeline --resolutions 0 2 --baseline report.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy
+import cv2
+
+from utils import *
+from params import Params
+from MonoCalibrator import MonoCalibrator
+from benchmarks.synthetic import SyntheticCamera , SyntheticBoard , render , random_pose
+
+MODELS = {"pinhole" : CAMERA_MODEL.PINHOLE,"fisheye" : CAMERA_MODEL.FISHEYE}
+
+# without them cv2.fisheye.calibrate does not converge on these images
+FISHEYE_FLAGS = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC | cv2.fisheye.CALIB_FIX_SKEW
+# solves reprojecting worse than this (px) have not converged, their accuracy is not a result
+MAX_RMS_PX = 2.0
+
+# report entry -> True if larger is better, compared against the baseline
+COMPARED = {
+    "get_corners_ms" : False,
+    "downsample_and_detect_ms" : False,
+    "get_corners_rms_px" : False,
+    "handle_msg_fps" : True,
+    "solve_s" : False,
+    "select_ms" : False,
+    "focal_error" : False,
+    "center_error_px" : False
+}
+
+
+def corner_rms(corners,truth):
+    """
+    RMS distance (px) of the detected corners to the nearest ground truth corner, whatever their order.
+    """
+    d = numpy.linalg.norm(corners.reshape(-1,1,2) - truth.reshape(1,-1,2),axis = 2).min(axis = 1)
+    return float(numpy.sqrt((d ** 2).mean()))
+
+
+def make_calibrator(board,camera_model,fisheye_flags = FISHEYE_FLAGS,argv = None):
+    # defaults, without the persistent caches so that every run measures the actual work
+    params = Params(["--corner_cache_size","0","--map_cache_size","0"] + (argv or []))
+    mc = MonoCalibrator([board],fisheye_flags = fisheye_flags,checkerboard_flags = cv2.CALIB_CB_FAST_CHECK,params = params)
+    mc.set_cammodel(camera_model)
+    return mc
+
+
+def bench_detection(camera,board,frames):
+    boards = [board]
+    get_time = []
+    detect_time = []
+    found = 0
+    errors = []
+    for (img,truth) in frames:
+        start = time.perf_counter()
+        (ok,corners) = get_corners(img,board,True,cv2.CALIB_CB_FAST_CHECK)
+        get_time.append(time.perf_counter() - start)
+        if ok:
+            found += 1
+            errors.append(corner_rms(corners,truth))
+        
+        start = time.perf_counter()
+        downsample_and_detect(img,boards,cv2.CALIB_CB_FAST_CHECK)
+        detect_time.append(time.perf_counter() - start)
+    return {
+        "get_corners_ms" : 1000.0 * float(numpy.mean(get_time)),
+        "downsample_and_detect_ms" : 1000.0 * float(numpy.mean(detect_time)),
+        "detection_rate" : found / float(len(frames)),
+        "get_corners_rms_px" : float(numpy.mean(errors)) if errors else None
+    }
+
+
+def bench_handle_msg(camera,board,frames):
+    mc = make_calibrator(board,camera.camera_model)
+    start = time.perf_counter()
+    for (img,_) in frames:
+        mc.handle_msg(img)
+    elapsed = time.perf_counter() - start
+    return {"handle_msg_fps" : len(frames) / elapsed,"samples_accepted" : len(mc.db)}
+
+
+def detected_views(board,frames):
+    good = []
+    for (img,_) in frames:
+        (ok,corners) = get_corners(img,board,True,cv2.CALIB_CB_FAST_CHECK)
+        if ok:
+            good.append((corners,board))
+    return good
+
+
+def intrinsics_errors(camera,mc):
+    K = camera.K
+    return {
+        "focal_error" : float(max(abs(mc.intrinsics[0,0] / K[0,0] - 1.0),abs(mc.intrinsics[1,1] / K[1,1] - 1.0))),
+        "center_error_px" : float(numpy.hypot(mc.intrinsics[0,2] - K[0,2],mc.intrinsics[1,2] - K[1,2]))
+    }
+
+
+def unconverged(rms):
+    """
+    Error message if a solve reprojecting with rms (px) has not converged, else None.
+    """
+    if rms > MAX_RMS_PX:
+        return "not converged : rms %.3g px > %g px" % (rms,MAX_RMS_PX)
+    return None
+
+
+def bench_solve(camera,board,frames,sample_counts,fisheye_flags = FISHEYE_FLAGS):
+    good = detected_views(board,frames)
+    
+    results = []
+    for n in sample_counts:
+        if n > len(good):
+            break
+        mc = make_calibrator(board,camera.camera_model,fisheye_flags)
+        mc.size = camera.size
+        result = {"samples" : n}
+        start = time.perf_counter()
+        try:
+            mc.cal_fromcorners(good[:n])
+        except cv2.error as e:
+            result["error"] = str(e).strip().splitlines()[-1]
+            results.append(result)
+            continue
+        result["solve_s"] = time.perf_counter() - start
+        if unconverged(mc.reproj_err):
+            result["error"] = unconverged(mc.reproj_err)
+            results.append(result)
+            continue
+        
+        result["rms_px"] = mc.reproj_err
+        result.update(intrinsics_errors(camera,mc))
+        n_coeffs = min(mc.distortion.size,camera.D.size)
+        result["distortion_error"] = float(numpy.abs(mc.distortion.ravel()[:n_coeffs] - camera.D.ravel()[:n_coeffs]).max())
+        results.append(result)
+    return results
+
+
+def bench_selection(camera,board,frames,select_counts,fisheye_flags = FISHEYE_FLAGS):
+    """
+    Solve over the views picked by --max_calib_samples vs over all of them.
+    """
+    good = detected_views(board,frames)
+    mc = make_calibrator(board,camera.camera_model,fisheye_flags)
+    mc.size = camera.size
+    (ipts,boards) = zip(*good)
+    start = time.perf_counter()
+    try:
+        mc.solve(mc.mk_object_points(boards),ipts)
+        # solve time alone, as in selection_report
+        full = {"solve_s" : time.perf_counter() - start}
+        mc.cal_fromcorners(good)
+        full.update(intrinsics_errors(camera,mc))
+    except cv2.error:
+        # e.g. a degenerate view breaks the fisheye solve over all of them, the subsets are still measured
+        full = None
+    if full is not None and unconverged(mc.reproj_err):
+        full = None
+    
+    results = []
+    for k in select_counts:
+        if k >= len(good):
+            break
+        mc = make_calibrator(board,camera.camera_model,fisheye_flags,["--max_calib_samples",str(k)])
+        mc.size = camera.size
+        try:
+            mc.cal_fromcorners(good)
+        except cv2.error as e:
+            results.append({"samples" : k,"error" : str(e).strip().splitlines()[-1]})
+            continue
+        report = mc.selection_report
+        error = unconverged(max(mc.reproj_err,report["heldout_rms"]))
+        if error:
+            results.append({"samples" : k,"error" : error})
+            continue
+        result = {"samples" : k,"views" : len(good),"select_ms" : report["select_ms"],"solve_s" : report["solve_s"],
+                  "heldout_rms_px" : report["heldout_rms"],"heldout_gap_px" : report["heldout_gap"]}
+        result.update(intrinsics_errors(camera,mc))
+        if full is not None:
+            result["full_solve_s"] = full["solve_s"]
+            result["focal_error_delta"] = result["focal_error"] - full["focal_error"]
+            result["center_error_delta_px"] = result["center_error_px"] - full["center_error_px"]
+        results.append(result)
+    return results
+
+
+def run(resolutions,models,board,n_frames,sample_counts,blur,noise,seed = 0,fisheye_flags = FISHEYE_FLAGS,select_counts = ()):
+    rng = numpy.random.default_rng(seed)
+    sboard = SyntheticBoard(board)
+    cam_resolution = Params([]).cam_resolution
+    report = []
+    for model in models:
+        for r in resolutions:
+            size = cam_resolution[r]
+            camera = SyntheticCamera(size,MODELS[model])
+            frames = []
+            for _ in range(n_frames):
+                (rvec,tvec) = random_pose(camera,sboard,rng)
+                frames.append(render(camera,sboard,rvec,tvec,blur,noise,rng))
+            
+            entry = {"model" : model,"resolution" : r,"width" : size[0],"height" : size[1]}
+            entry.update(bench_detection(camera,board,frames))
+            entry.update(bench_handle_msg(camera,board,frames))
+            entry["solve"] = bench_solve(camera,board,frames,sample_counts,fisheye_flags)
+            entry["selection"] = bench_selection(camera,board,frames,select_counts,fisheye_flags)
+            report.append(entry)
+            print_entry(entry)
+    return report
+
+
+def print_entry(entry):
+    print("%-8s %5dx%-5d get_corners %8.2f ms , downsample_and_detect %8.2f ms , detected %3.0f%% , corner rms %s px , handle_msg %6.1f fps" % (
+        entry["model"],entry["width"],entry["height"],entry["get_corners_ms"],entry["downsample_and_detect_ms"],100.0 * entry["detection_rate"],
+        "%.3f" % entry["get_corners_rms_px"] if entry["get_corners_rms_px"] is not None else "-",entry["handle_msg_fps"]))
+    for s in entry["solve"]:
+        if "error" in s:
+            print("%26s %3d samples : %s" % ("",s["samples"],s["error"]))
+        else:
+            print("%26s %3d samples : solve %7.3f s , focal error %.4f , center error %.2f px , distortion error %.4f" % (
+                "",s["samples"],s["solve_s"],s["focal_error"],s["center_error_px"],s["distortion_error"]))
+    for s in entry.get("selection",[]):
+        if "error" in s:
+            print("%26s %3d selected : %s" % ("",s["samples"],s["error"]))
+        elif "full_solve_s" not in s:
+            print("%26s %3d of %3d selected in %.2f ms : solve %7.3f s (all failed) , focal error %.4f , center error %.2f px , left out rms %.3f px" % (
+                "",s["samples"],s["views"],s["select_ms"],s["solve_s"],s["focal_error"],s["center_error_px"],s["heldout_rms_px"]))
+        else:
+            print("%26s %3d of %3d selected in %.2f ms : solve %7.3f s (all %7.3f s) , focal error %+.4f , center error %+.2f px vs all , left out rms %.3f px" % (
+                "",s["samples"],s["views"],s["select_ms"],s["solve_s"],s["full_solve_s"],s["focal_error_delta"],s["center_error_delta_px"],s["heldout_rms_px"]))
+
+
+def compare(report,baseline,tolerance):
+    """
+    Regressions of report against baseline, as a list of messages.
+    """
+    def key(entry):
+        return (entry["model"],entry["resolution"])
+    
+    def check(name,label,value,reference):
+        if value is None or reference is None or name not in COMPARED:
+            return
+        if COMPARED[name]:
+            if value < reference * (1.0 - tolerance):
+                regressions.append("%s %s : %.4g < %.4g" % (label,name,value,reference))
+        elif value > reference * (1.0 + tolerance) and value - reference > 1e-6:
+            regressions.append("%s %s : %.4g > %.4g" % (label,name,value,reference))
+    
+    regressions = []
+    baseline = {key(entry) : entry for entry in baseline["results"]}
+    for entry in report["results"]:
+        reference = baseline.get(key(entry))
+        if reference is None:
+            continue
+        label = "%s %dx%d" % (entry["model"],entry["width"],entry["height"])
+        for name in COMPARED:
+            check(name,label,entry.get(name),reference.get(name))
+        solves = {s["samples"] : s for s in reference["solve"]}
+        for s in entry["solve"]:
+            if "error" in s and "error" not in solves.get(s["samples"],{"error" : None}):
+                regressions.append("%s %d samples : %s" % (label,s["samples"],s["error"]))
+            for name in COMPARED:
+                check(name,"%s %d samples" % (label,s["samples"]),s.get(name),solves.get(s["samples"],{}).get(name))
+        selections = {s["samples"] : s for s in reference.get("selection",[])}
+        for s in entry.get("selection",[]):
+            if "error" in s and "error" not in selections.get(s["samples"],{"error" : None}):
+                regressions.append("%s %d selected : %s" % (label,s["samples"],s["error"]))
+            for name in COMPARED:
+                check(name,"%s %d selected" % (label,s["samples"]),s.get(name),selections.get(s["samples"],{}).get(name))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__,formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resolutions",type=int,nargs="*",default=None,help="Params.cam_resolution entries to benchmark. (default:all)")
+    parser.add_argument("--models",type=str,nargs="*",default=list(MODELS),choices=list(MODELS),help="Camera models to benchmark. (default:pinhole fisheye)")
+    parser.add_argument("--chessboard_w",type=int,default=6,help="No of inner corners in horizontal direction. (default:6)")
+    parser.add_argument("--chessboard_h",type=int,default=4,help="No of inner corners in vertical direction. (default:4)")
+    parser.add_argument("--chessboard_sqr_size",type=float,default=0.04,help="Size of a square in m. (default:0.04)")
+    parser.add_argument("--frames",type=int,default=40,help="Number of rendered poses per model and resolution. (default:40)")
+    parser.add_argument("--sample_counts",type=int,nargs="*",default=[10,20,40],help="Numbers of samples cal_fromcorners is timed with. (default:10 20 40)")
+    parser.add_argument("--select_counts",type=int,nargs="*",default=[20],help="--max_calib_samples values the view selection is benchmarked with. (default:20)")
+    parser.add_argument("--blur",type=float,default=0.8,help="Gaussian blur sigma in px. (default:0.8)")
+    parser.add_argument("--noise",type=float,default=2.0,help="Gaussian noise sigma in grey levels. (default:2.0)")
+    parser.add_argument("--fisheye_flags",type=int,default=FISHEYE_FLAGS,help="cv2.fisheye.calibrate flags. (default:%d i.e CALIB_RECOMPUTE_EXTRINSIC | CALIB_FIX_SKEW)" % FISHEYE_FLAGS)
+    parser.add_argument("--seed",type=int,default=0,help="Seed of the poses and noise. (default:0)")
+    parser.add_argument("--output",type=str,default="benchmark_report.json",help="JSON report. (default:benchmark_report.json)")
+    parser.add_argument("--baseline",type=str,default=None,help="Report of a previous run to compare against.")
+    parser.add_argument("--tolerance",type=float,default=0.2,help="Relative slow-down or accuracy loss reported as a regression. (default:0.2)")
+    args = parser.parse_args()
+    
+    resolutions = args.resolutions if args.resolutions is not None else sorted(Params([]).cam_resolution)
+    board = ChessboardInfo(max(args.chessboard_w,args.chessboard_h),min(args.chessboard_w,args.chessboard_h),args.chessboard_sqr_size)
+    
+    results = run(resolutions,args.models,board,args.frames,args.sample_counts,args.blur,args.noise,args.seed,args.fisheye_flags,args.select_counts)
+    report = {
+        "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment" : {"python" : platform.python_version(),"opencv" : cv2.__version__,"numpy" : numpy.__version__,
+                         "machine" : platform.machine(),"processor" : platform.processor(),"cpus" : cv2.getNumberOfCPUs()},
+        "config" : vars(args),
+        "results" : results
+    }
+    with open(args.output,"w") as f:
+        json.dump(report,f,indent = 2)
+    print("report written to %s" % args.output)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report,json.load(f),args.tolerance)
+        for r in regressions:
+            print("REGRESSION %s" % r)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,52 @@
+"""
+Nearest sample query of Calibrator.is_good_sample: linear scan of the database vs. the SampleIndex grid hash.
+"""
+import argparse
+import time
+import numpy
+
+from utils import SampleIndex
+
+
+def scan_min_distance(db_params,params):
+    """
+    The previous is_good_sample implementation.
+    """
+    def param_distance(p1,p2):
+        return sum([abs(a-b) for (a,b) in zip(p1,p2)])
+    
+    return min([param_distance(params,p) for p in db_params])
+
+
+def run(sample_counts = (40,400,4000),queries = 2000,radius = 0.2,seed = 0):
+    rng = numpy.random.default_rng(seed)
+    results = []
+    for n in sample_counts:
+        db_params = rng.random((n,4)).tolist()
+        query_params = rng.random((queries,4)).tolist()
+        
+        index = SampleIndex(radius)
+        for p in db_params:
+            index.add(p)
+            
+        start = time.perf_counter()
+        scan = [scan_min_distance(db_params,q) <= radius for q in query_params]
+        scan_time = (time.perf_counter() - start) / queries
+        
+        start = time.perf_counter()
+        indexed = [index.min_distance(q,radius) is not None for q in query_params]
+        index_time = (time.perf_counter() - start) / queries
+        
+        assert scan == indexed, "index and scan disagree"
+        results.append({"samples" : n,"scan_us" : scan_time * 1e6,"index_us" : index_time * 1e6})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument("--queries",type=int,default=2000,help="Number of queries per database size. (default:2000)")
+    args = parser.parse_args()
+    
+    print("%8s %12s %12s %8s" % ("samples","scan [us]","index [us]","speedup"))
+    for r in run(queries = args.queries):
+        print("%8d %12.1f %12.1f %8.1f" % (r["samples"],r["scan_us"],r["index_us"],r["scan_us"] / r["index_us"]))
@@ -0,0 +1,175 @@
+"""
+Synthetic checkerboard images rendered under known pinhole or equidistant fisheye intrinsics, with the
+ground truth corners, for benchmarking detection and calibration.
+"""
+import math
+import numpy
+import cv2
+
+from utils import CAMERA_MODEL
+
+
+class SyntheticCamera():
+    """
+    Camera with known intrinsics (K, distortion) rendering a planar checkerboard by ray casting : the ray of
+    every pixel is computed once, each pose then only intersects them with the board plane.
+    """
+    # px per square of the board texture
+    TEXTURE_SCALE = 32
+    BACKGROUND = 170
+    # fisheye rays beyond this angle from the optical axis are not rendered
+    FISHEYE_MAX_THETA = math.radians(85.0)
+    
+    def __init__(self,size,camera_model = CAMERA_MODEL.PINHOLE,K = None,D = None):
+        (w,h) = size
+        self.size = size
+        self.camera_model = camera_model
+        if camera_model == CAMERA_MODEL.FISHEYE:
+            # equidistant projection r = f * theta, 85 deg at about the left and right borders
+            f = 0.5 * w / self.FISHEYE_MAX_THETA
+            self.K = K if K is not None else numpy.array([[f,0,w / 2.0 + 3.5],[0,f,h / 2.0 - 2.5],[0,0,1]])
+            self.D = D if D is not None else numpy.array([[0.03],[-0.01],[0.002],[0.0]])
+        else:
+            f = 0.9 * w
+            self.K = K if K is not None else numpy.array([[f,0,w / 2.0 + 3.5],[0,f,h / 2.0 - 2.5],[0,0,1]])
+            self.D = D if D is not None else numpy.array([[-0.25],[0.08],[0.0],[0.0],[0.0]])
+        self._rays = None
+        self._valid = None
+    
+    def rays(self):
+        """
+        Direction (x,y,1) of the ray of every pixel, and whether it is rendered.
+        """
+        if self._rays is None:
+            (w,h) = self.size
+            (u,v) = numpy.meshgrid(numpy.arange(w,dtype = numpy.float64),numpy.arange(h,dtype = numpy.float64))
+            pixels = numpy.stack([u.ravel(),v.ravel()],axis = 1).reshape(-1,1,2)
+            if self.camera_model == CAMERA_MODEL.FISHEYE:
+                normalized = cv2.fisheye.undistortPoints(pixels,self.K,self.D).reshape(-1,2)
+                # distorted angle of FISHEYE_MAX_THETA
+                theta = self.FISHEYE_MAX_THETA
+                k = self.D.ravel()
+                theta_d = theta * (1 + k[0] * theta ** 2 + k[1] * theta ** 4 + k[2] * theta ** 6 + k[3] * theta ** 8)
+                r = numpy.hypot((u.ravel() - self.K[0,2]) / self.K[0,0],(v.ravel() - self.K[1,2]) / self.K[1,1])
+                valid = r < theta_d
+            else:
+                normalized = cv2.undistortPoints(pixels,self.K,self.D).reshape(-1,2)
+                valid = numpy.ones(w * h,dtype = bool)
+            self._rays = numpy.hstack([normalized,numpy.ones((w * h,1))])
+            self._valid = valid
+        return (self._rays,self._valid)
+    
+    def project(self,object_points,rvec,tvec):
+        """
+        Image points (N,1,2) of object points (N,1,3) seen from the pose (rvec,tvec).
+        """
+        if self.camera_model == CAMERA_MODEL.FISHEYE:
+            (points,_) = cv2.fisheye.projectPoints(object_points.astype(numpy.float64),rvec,tvec,self.K,self.D)
+        else:
+            (points,_) = cv2.projectPoints(object_points.astype(numpy.float64),rvec,tvec,self.K,self.D)
+        return points.reshape(-1,1,2).astype(numpy.float32)
+    
+    def ray(self,pixel):
+        point = numpy.array([[pixel]],dtype = numpy.float64)
+        if self.camera_model == CAMERA_MODEL.FISHEYE:
+            (x,y) = cv2.fisheye.undistortPoints(point,self.K,self.D).ravel()
+        else:
+            (x,y) = cv2.undistortPoints(point,self.K,self.D).ravel()
+        return numpy.array([x,y,1.0])
+
+
+class SyntheticBoard():
+    """
+    Checkerboard of board.n_cols x board.n_rows inner corners with squares of board.dim, inner corner (c,r)
+    at (c * dim,r * dim,0) in the board frame, in the corner order of cv2.findChessboardCorners.
+    """
+    
+    def __init__(self,board):
+        self.board = board
+        (n_cols,n_rows,dim) = (board.n_cols,board.n_rows,board.dim)
+        ids = numpy.arange(n_cols * n_rows)
+        self.object_points = numpy.zeros((n_cols * n_rows,1,3),dtype = numpy.float64)
+        self.object_points[:,0,0] = (ids % n_cols) * dim
+        self.object_points[:,0,1] = (ids // n_cols) * dim
+        self.center = numpy.array([(n_cols - 1) * dim / 2.0,(n_rows - 1) * dim / 2.0,0.0])
+        
+        # texture : n_cols+1 x n_rows+1 squares and a white margin of one square
+        s = SyntheticCamera.TEXTURE_SCALE
+        (tw,th) = ((n_cols + 3) * s,(n_rows + 3) * s)
+        (tu,tv) = numpy.meshgrid(numpy.arange(tw),numpy.arange(th))
+        (a,b) = (tu // s - 1,tv // s - 1)
+        inner = (a >= 0) & (a <= n_cols) & (b >= 0) & (b <= n_rows)
+        self.texture = numpy.where(inner & ((a + b) % 2 == 0),0,255).astype(numpy.uint8)
+    
+    def width(self):
+        return (self.board.n_cols + 3) * self.board.dim
+    
+    def texture_coords(self,X,Y):
+        s = SyntheticCamera.TEXTURE_SCALE / self.board.dim
+        # texture pixel i spans [i - 0.5,i + 0.5) for cv2.remap
+        return ((X + 2 * self.board.dim) * s - 0.5,(Y + 2 * self.board.dim) * s - 0.5)
+
+
+def render(camera,board,rvec,tvec,blur = 0.8,noise = 2.0,rng = None):
+    """
+    Image of the board at pose (rvec,tvec) with gaussian blur (sigma in px) and noise (sigma in grey levels),
+    and the ground truth corners.
+    """
+    (w,h) = camera.size
+    (rays,valid) = camera.rays()
+    R = cv2.Rodrigues(rvec)[0]
+    t = numpy.asarray(tvec,dtype = numpy.float64).ravel()
+    
+    # rays in the board frame, intersected with its plane z = 0
+    rays_b = rays @ R
+    origin_b = -R.T @ t
+    with numpy.errstate(divide = "ignore",invalid = "ignore"):
+        s = -origin_b[2] / rays_b[:,2]
+    hit = valid & (s > 0)
+    X = origin_b[0] + s * rays_b[:,0]
+    Y = origin_b[1] + s * rays_b[:,1]
+    (mapx,mapy) = board.texture_coords(X,Y)
+    mapx = numpy.where(hit,mapx,-1.0).astype(numpy.float32).reshape(h,w)
+    mapy = numpy.where(hit,mapy,-1.0).astype(numpy.float32).reshape(h,w)
+    
+    img = cv2.remap(board.texture,mapx,mapy,cv2.INTER_LINEAR,borderMode = cv2.BORDER_CONSTANT,borderValue = SyntheticCamera.BACKGROUND)
+    if blur > 0:
+        img = cv2.GaussianBlur(img,(0,0),blur)
+    if noise > 0:
+        rng = rng if rng is not None else numpy.random.default_rng()
+        img = numpy.clip(img + rng.normal(0.0,noise,img.shape),0,255).astype(numpy.uint8)
+    return (img,camera.project(board.object_points,rvec,tvec))
+
+
+def random_pose(camera,board,rng,fill = (0.25,0.6),max_tilt = 35.0,margin = 20):
+    """
+    Random pose (rvec,tvec) with the board covering a fill fraction of the image width, tilted by up to
+    max_tilt degrees, and all its corners at least margin px inside the image (and the rendered fisheye disc).
+    """
+    (w,h) = camera.size
+    f = camera.K[0,0]
+    for _ in range(100):
+        (rx,ry) = numpy.radians(rng.uniform(-max_tilt,max_tilt,2))
+        rz = numpy.radians(rng.uniform(-20.0,20.0))
+        R = cv2.Rodrigues(numpy.array([rx,0.0,0.0]))[0] @ cv2.Rodrigues(numpy.array([0.0,ry,0.0]))[0] @ cv2.Rodrigues(numpy.array([0.0,0.0,rz]))[0]
+        rvec = cv2.Rodrigues(R)[0]
+        
+        distance = f * board.width() / (rng.uniform(*fill) * w)
+        pixel = (rng.uniform(0.25,0.75) * w,rng.uniform(0.25,0.75) * h)
+        ray = camera.ray(pixel)
+        tvec = (distance * ray / numpy.linalg.norm(ray) - R @ board.center).reshape(3,1)
+        
+        corners = camera.project(board.object_points,rvec,tvec).reshape(-1,2)
+        depth = (board.object_points.reshape(-1,3) @ R.T + tvec.ravel())[:,2]
+        if depth.min() <= 0:
+            continue
+        if corners[:,0].min() < margin or corners[:,1].min() < margin or corners[:,0].max() > w - margin or corners[:,1].max() > h - margin:
+            continue
+        if camera.camera_model == CAMERA_MODEL.FISHEYE:
+            # stay within 60 deg of the axis : cv2.fisheye.calibrate fails to initialize the extrinsics (NaN
+            # undistorted points) of views reaching close to the edge of the disc
+            theta = numpy.arccos(numpy.clip(depth / numpy.linalg.norm(board.object_points.reshape(-1,3) @ R.T + tvec.ravel(),axis = 1),-1,1))
+            if theta.max() > camera.FISHEYE_MAX_THETA - math.radians(25.0):
+                continue
+        return (rvec,tvec)
+    raise RuntimeError("No valid board pose found, is the board too large for the image?")
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy
+
+
+class DiskCache:
+    """
+    Directory of .npz entries with size-bounded LRU eviction.
+    The modification time of an entry is its last use, so the cache ordering survives restarts.
+    The directory is only created by the first entry stored.
+    """
+    
+    def __init__(self,cache_dir,max_bytes):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        
+        self._size = 0
+        if os.path.isdir(self.cache_dir):
+            self._size = sum(e.stat().st_size for e in os.scandir(self.cache_dir) if e.name.endswith(".npz"))
+        
+    def path(self,key):
+        return os.path.join(self.cache_dir,key + ".npz")
+        
+    def load(self,key):
+        """
+        Return the arrays stored under key, or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            with numpy.load(path) as entry:
+                arrays = {name : entry[name] for name in entry.files}
+            # mark as recently used
+            os.utime(path)
+        except (OSError,ValueError):
+            return None
+        return arrays
+    
+    def store(self,key,**arrays):
+        path = self.path(key)
+        os.makedirs(self.cache_dir,exist_ok = True)
+        # write to a temporary file first so that readers (or a crash) never see a partial entry
+        tmp = "%s.%d.%d.tmp" % (path,os.getpid(),threading.get_ident())
+        with open(tmp,"wb") as f:
+            numpy.savez(f,**arrays)
+        size = os.path.getsize(tmp)
+        
+        with self._lock:
+            # an entry overwritten under the same key no longer counts
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp,path)
+            self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+                
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is back under 90% of its size limit.
+        """
+        entries = sorted((e.stat().st_mtime,e.stat().st_size,e.path) for e in os.scandir(self.cache_dir) if e.name.endswith(".npz"))
+        self._size = sum(size for (_,size,_) in entries)
+        for (_,size,path) in entries:
+            if self._size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            
+
+class CornerCache(DiskCache):
+    """
+    Persistent cache of refined checkerboard corners, keyed by the image content, the board geometry and
+    the detection flags. Negative results (no board in the image) are cached as well.
+    """
+    
+    @staticmethod
+    def key(data,boards,checkerboard_flags,refine = True):
+        """
+        :param data: image content, either the raw pixels (see image_data) or the encoded image file
+        """
+        h = hashlib.sha1()
+        h.update(data)
+        h.update(repr([(b.n_cols,b.n_rows) for b in boards]).encode("utf-8"))
+        h.update(repr((checkerboard_flags,refine)).encode("utf-8"))
+        return h.hexdigest()
+    
+    @staticmethod
+    def image_data(img):
+        return repr((img.shape,img.dtype.str)).encode("utf-8") + numpy.ascontiguousarray(img).tobytes()
+    
+    def get(self,key,boards):
+        """
+        Returns (ok,corners,board,(width,height)) or None on a miss.
+        """
+        entry = self.load(key)
+        if entry is None:
+            return None
+        size = tuple(int(v) for v in entry["size"])
+        if not entry["ok"]:
+            return (False,None,None,size)
+        return (True,entry["corners"],boards[int(entry["board"])],size)
+    
+    def put(self,key,result,boards):
+        (ok,corners,board,size) = result
+        if ok:
+            # board may be a copy coming back from a worker process, so match it by geometry
+            index = [(b.n_cols,b.n_rows) for b in boards].index((board.n_cols,board.n_rows))
+            self.store(key,ok = True,corners = corners,board = index,size = size)
+        else:
+            self.store(key,ok = False,size = size)
+
+
+class MapCache():
+    """
+    Cache of undistortion maps keyed by intrinsics, distortion, image size, alpha, camera model and map format.
+    Recently used maps are kept in memory and, when a directory is given, also stored as .npz files which
+    carry the calibration they were computed from, so other processes (e.g. the robot runtime) can load them.
+    """
+    
+    def __init__(self,max_entries = 8,cache_dir = None,max_bytes = 0):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.disk = None
+        if cache_dir and max_bytes > 0:
+            self.disk = DiskCache(cache_dir,max_bytes)
+            
+    @staticmethod
+    def key(K,D,R,size,alpha,model,out_size,m1type):
+        h = hashlib.sha1()
+        for m in (K,D,R):
+            h.update(numpy.ascontiguousarray(m,dtype = numpy.float64).tobytes())
+        h.update(repr((tuple(size),float(alpha),model,tuple(out_size),m1type)).encode("utf-8"))
+        return h.hexdigest()
+    
+    def get(self,key):
+        """
+        Returns (map1,map2) or None on a miss.
+        """
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        if self.disk is None:
+            return None
+        entry = self.disk.load(key)
+        if entry is None:
+            return None
+        maps = (entry["map1"],entry["map2"])
+        self.remember(key,maps)
+        return maps
+    
+    def put(self,key,maps,**calibration):
+        """
+        :param calibration: arrays describing the calibration, stored alongside the maps on disk
+        """
+        self.remember(key,maps)
+        if self.disk is not None:
+            self.disk.store(key,map1 = maps[0],map2 = maps[1],**calibration)
+            
+    def remember(self,key,maps):
+        with self._lock:
+            self.entries[key] = maps
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
@@ -0,0 +1,234 @@
+import threading
+import time
+import bisect
+from contextlib import contextmanager
+
+from calib_logger import CalibLogger
+
+
+class Counter():
+    """
+    Monotonic counter, e.g. frames discarded by a queue.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+    
+    def inc(self,n = 1):
+        with self._lock:
+            self.value += n
+
+
+class Histogram():
+    """
+    Latency histogram with fixed buckets (in seconds), cumulative as in the Prometheus exposition format.
+    """
+    BUCKETS = (0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+    
+    def __init__(self,buckets = BUCKETS):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self,value):
+        i = bisect.bisect_left(self.buckets,value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+    
+    def snapshot(self):
+        with self._lock:
+            return (list(self.counts),self.sum,self.count)
+    
+    def quantile(self,q,counts = None,count = None):
+        """
+        Upper bound of the bucket holding the q quantile, inf if it is in the +Inf bucket.
+        """
+        if counts is None:
+            (counts,_,count) = self.snapshot()
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for (bound,n) in zip(self.buckets,counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics():
+    """
+    Per-stage latency histograms and counters of the calibration pipeline, shared by all the sessions of the
+    process.
+    
+    Stages are timed with
+        
+        with METRICS.timer("find_chessboard_corners"):
+            ...
+    
+    which costs two perf_counter calls and a bucket increment. They are exposed in the Prometheus text
+    format by render() (the /metrics endpoint) and summarized periodically in the log by start_logging().
+    
+    The threads of a camera session call bind_camera() first, so that the stages they time and the counters
+    of their queues carry a camera label and concurrent sessions can be told apart.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (stage,camera or None) -> Histogram of its duration
+        self.stages = dict()
+        # (name,queue or None,camera or None) -> Counter
+        self.counters = dict()
+        # camera label of the calling thread
+        self._local = threading.local()
+        self._log_thread = None
+        self._last_log = dict()
+        # list of (stage,thread id,start,end) spans while the profiler records a trace, else None
+        self.trace = None
+    
+    def bind_camera(self,camera):
+        """
+        Label the stages timed from now on by the calling thread with camera, None for no label.
+        """
+        self._local.camera = None if camera is None else str(camera)
+    
+    def camera(self):
+        """
+        Camera label bound to the calling thread, None if there is none.
+        """
+        return getattr(self._local,"camera",None)
+    
+    def histogram(self,stage,camera = None):
+        key = (stage,camera)
+        h = self.stages.get(key)
+        if h is None:
+            with self._lock:
+                h = self.stages.setdefault(key,Histogram())
+        return h
+    
+    def counter(self,name,queue = None,camera = None):
+        key = (name,queue,None if camera is None else str(camera))
+        c = self.counters.get(key)
+        if c is None:
+            with self._lock:
+                c = self.counters.setdefault(key,Counter())
+        return c
+    
+    def observe(self,stage,seconds):
+        self.histogram(stage,self.camera()).observe(seconds)
+        trace = self.trace
+        if trace is not None:
+            end = time.perf_counter()
+            trace.append((stage,threading.get_ident(),end - seconds,end))
+    
+    @contextmanager
+    def timer(self,stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.histogram(stage,self.camera()).observe(end - start)
+            trace = self.trace
+            if trace is not None:
+                trace.append((stage,threading.get_ident(),start,end))
+    
+    @staticmethod
+    def _sort_key(item):
+        # None (no label) sorts first
+        return tuple(label or "" for label in item[0])
+    
+    @staticmethod
+    def labels(**labels):
+        """
+        Prometheus label list of the labels that are not None, in the order given.
+        """
+        return ",".join('%s="%s"' % (name,value) for (name,value) in labels.items() if value is not None)
+    
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = ["# HELP calib_stage_seconds Duration of the stages of the calibration pipeline.",
+                 "# TYPE calib_stage_seconds histogram"]
+        with self._lock:
+            stages = sorted(self.stages.items(),key = self._sort_key)
+            counters = sorted(self.counters.items(),key = self._sort_key)
+        for ((stage,camera),h) in stages:
+            (counts,total,count) = h.snapshot()
+            labels = self.labels(stage = stage,camera = camera)
+            cumulative = 0
+            for (bound,n) in zip(h.buckets,counts):
+                cumulative += n
+                lines.append('calib_stage_seconds_bucket{%s,le="%g"} %d' % (labels,bound,cumulative))
+            lines.append('calib_stage_seconds_bucket{%s,le="+Inf"} %d' % (labels,count))
+            lines.append('calib_stage_seconds_sum{%s} %.9f' % (labels,total))
+            lines.append('calib_stage_seconds_count{%s} %d' % (labels,count))
+        
+        typed = set()
+        for ((name,queue,camera),c) in counters:
+            if name not in typed:
+                lines.append("# TYPE %s counter" % name)
+                typed.add(name)
+            labels = self.labels(queue = queue,camera = camera)
+            if not labels:
+                lines.append("%s %d" % (name,c.value))
+            else:
+                lines.append('%s{%s} %d' % (name,labels,c.value))
+        return "\n".join(lines) + "\n"
+    
+    def summary(self):
+        """
+        Count, mean and approximate p50/p95 (bucket upper bounds) of every stage since the previous summary,
+        and the counters.
+        """
+        with self._lock:
+            stages = sorted(self.stages.items(),key = self._sort_key)
+            counters = sorted(self.counters.items(),key = self._sort_key)
+        lines = []
+        for (key,h) in stages:
+            (counts,total,count) = h.snapshot()
+            (last_counts,last_total,last_count) = self._last_log.get(key,([0] * len(counts),0.0,0))
+            self._last_log[key] = (counts,total,count)
+            n = count - last_count
+            if n == 0:
+                continue
+            window = [a - b for (a,b) in zip(counts,last_counts)]
+            (stage,camera) = key
+            lines.append("%-24s n = %6d , mean = %8.3f ms , p50 <= %g ms , p95 <= %g ms" % (stage if camera is None else "%s[%s]" % (stage,camera),n,
+                                                                                           1000.0 * (total - last_total) / n,
+                                                                                           1000.0 * h.quantile(0.5,window,n),
+                                                                                           1000.0 * h.quantile(0.95,window,n)))
+        for ((name,queue,camera),c) in counters:
+            labels = ",".join(label for label in (queue,camera) if label is not None)
+            lines.append("%-24s %d" % (name if not labels else "%s[%s]" % (name,labels),c.value))
+        return lines
+    
+    def start_logging(self,interval):
+        """
+        Log the summary every interval seconds, once per process whatever the number of callers.
+        """
+        with self._lock:
+            if interval <= 0 or self._log_thread is not None:
+                return
+            self._log_thread = threading.Thread(target = self._log_loop,args = (interval,))
+            self._log_thread.daemon = True
+            self._log_thread.start()
+    
+    def _log_loop(self,interval):
+        logger = CalibLogger().get_logger()
+        while True:
+            time.sleep(interval)
+            lines = self.summary()
+            if lines:
+                logger.info("########## pipeline metrics (last %g s) ##########\n%s" % (interval,"\n".join(lines)))
+
+
+# process wide registry
+METRICS = Metrics()
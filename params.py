@@ -2,7 +2,10 @@ import argparse
 
 class Params:
     
-    def __init__(self):
+    def __init__(self,argv = None):
+        """
+        argv defaults to the command line, e.g. Params([]) gives the defaults.
+        """
         
         self.parser = argparse.ArgumentParser(description="Fisheye Calibrator for SeeCamCU20 USB Camera")
         
@@ -10,7 +13,54 @@ class Params:
         self.parser.add_argument("--chessboard_h",type=int,default=4,help="No of corners in vertical direction in chessboard. (default = 7)")
         self.parser.add_argument("--chessboard_sqr_size",type=float,default=0.04,help="size of black square in chessborad (in m). (default = 0.04)")
         self.parser.add_argument("--resolution",type=int,default=0,help="resolution of camers. (default : 0 : (640,480)), available resolution 0:(640,480) , 1:(960,540) , 2:(1280,720) , 3:(1280,960) , 4:(1920,1080)")
+        self.parser.add_argument("--fourcc",type=str,default="MJPG",help="Pixel format requested from the camera, e.g. MJPG or UYVY. MJPG allows full frame rate at high resolutions. (default:MJPG)")
+        self.parser.add_argument("--fps",type=int,default=30,help="Frame rate requested from the camera. (default:30)")
+        self.parser.add_argument("--capture_buffers",type=int,default=2,help="Number of V4L2 buffers requested from the driver. (default:2)")
         self.parser.add_argument("--sample_count",type=int,default=40,help="Number of images to consider for calibration. (default:40)")
+        self.parser.add_argument("--coverage_bins",type=int,default=10,help="Number of bins of the per-parameter sample coverage histogram, 0 disables it. (default:10)")
+        self.parser.add_argument("--sample_storage",type=str,default="raw",choices=["raw","none","png","jpeg","disk","spool"],help="How the images of the accepted samples are kept : raw in memory, not at all (corners only), compressed in memory, as files or in a memory-mapped spool in --sample_dir. (default:raw)")
+        self.parser.add_argument("--sample_dir",type=str,default="/tmp/calibration_samples",help="Directory for the sample images with --sample_storage disk or spool. (default:/tmp/calibration_samples)")
+        self.parser.add_argument("--jpeg_quality",type=int,default=95,help="JPEG quality of the sample images with --sample_storage jpeg. (default:95)")
+        self.parser.add_argument("--roi_tracking",action="store_true",help="Search the checkerboard around its previous detection first, and in the full frame only after a miss.")
+        self.parser.add_argument("--detection_area",type=int,default=640*480,help="Number of pixels of the downsampled image the checkerboard is detected in, corners are always refined at full resolution. (default:307200 i.e 640x480)")
+        self.parser.add_argument("--detection_latency_ms",type=float,default=0,help="Detection latency budget in ms. When set, the detection resolution is tuned automatically to hold it. (default:0 i.e fixed --detection_area)")
+        self.parser.add_argument("--frame_gate",action="store_true",help="Skip the checkerboard detection for static, blurry and board-less frames, using cheap tests on a downscaled frame.")
+        self.parser.add_argument("--gate_min_sharpness",type=float,default=15.0,help="Frames with a Laplacian variance below this are skipped as blurry by the frame gate. (default:15)")
+        self.parser.add_argument("--gate_static_threshold",type=float,default=1.0,help="Frames whose mean absolute difference to the last detected frame (at 80x60) is below this reuse its detection. (default:1.0)")
+        self.parser.add_argument("--gate_max_static",type=int,default=15,help="Number of frames in a row that may reuse a detection before the next one is detected again. (default:15)")
+        self.parser.add_argument("--detection_workers",type=int,default=0,help="Number of worker processes used for checkerboard detection, 0 detects in the consumer thread. (default:0)")
+        self.parser.add_argument("--corner_cache_dir",type=str,default="~/.cache/seecam_calibrator/corners",help="Directory of the persistent cache of detected checkerboard corners. (default:~/.cache/seecam_calibrator/corners)")
+        self.parser.add_argument("--corner_cache_size",type=int,default=0,help="Size limit of the corner cache in MB, e.g. 256 to recalibrate from the same images without detecting them again. (default:0 i.e disabled)")
+        self.parser.add_argument("--map_cache_entries",type=int,default=8,help="Number of undistortion maps kept in memory, e.g. while scrubbing alpha. (default:8)")
+        self.parser.add_argument("--map_cache_dir",type=str,default="~/.cache/seecam_calibrator/maps",help="Directory of the persistent cache of undistortion maps (.npz). (default:~/.cache/seecam_calibrator/maps)")
+        self.parser.add_argument("--map_cache_size",type=int,default=0,help="Size limit of the persistent undistortion map cache in MB, e.g. 512 to share the maps with other processes. (default:0 i.e maps kept in memory only)")
+        self.parser.add_argument("--robust_calibration",action="store_true",help="Drop the samples with a large reprojection error and calibrate again from the previous estimate.")
+        self.parser.add_argument("--reproj_threshold",type=float,default=1.0,help="RMS reprojection error in px above which --robust_calibration drops a sample, raised to 3 times the median sample error if larger. (default:1.0)")
+        self.parser.add_argument("--robust_iterations",type=int,default=5,help="Maximum number of solves of --robust_calibration. (default:5)")
+        self.parser.add_argument("--max_calib_samples",type=int,default=0,help="Calibrate from at most this many samples, the most diverse ones, to bound the solve time. (default:0 i.e all)")
+        self.parser.add_argument("--live_preview_every",type=int,default=0,help="Solve in the background every this many new samples, each solve starting from the previous one, to show the estimate converge and start the final calibration from it. (default:0 i.e disabled)")
+        self.parser.add_argument("--calibration_timeout",type=float,default=300,help="Calibration jobs still running after this many seconds are stopped, 0 never stops them. (default:300)")
+        
+        #################### preview stream (/video_feed) ############################
+        self.parser.add_argument("--stream_quality",type=int,default=95,help="JPEG quality of the preview stream, overridden by the quality query parameter. (default:95)")
+        self.parser.add_argument("--stream_max_fps",type=float,default=0,help="Frame rate cap of the preview stream, overridden by the max_fps query parameter. (default:0 i.e every displayed frame)")
+        self.parser.add_argument("--stream_scale",type=float,default=1.0,help="Scale of the preview stream, overridden by the scale query parameter. (default:1.0)")
+        self.parser.add_argument("--stream_adaptive",action="store_true",help="Lower the quality and the frame rate of the preview stream while the encoder or the client falls behind, overridden by the adaptive query parameter.")
+        
+        self.parser.add_argument("--metrics_log_interval",type=float,default=60,help="Interval in seconds of the pipeline latency summary in the log, the same metrics are served on /metrics. 0 disables the summary. (default:60)")
+        self.parser.add_argument("--profile_dir",type=str,default="/tmp/calibration_profiles",help="Directory of the profiles (.prof) and traces (.json) recorded by /profile or $CALIB_PROFILE. (default:/tmp/calibration_profiles)")
+        
+        #################### offline batch calibration (batch_calibrate.py) ############################
+        self.parser.add_argument("--batch_input",type=str,nargs="*",default=[],help="tar archives written by the calibrator (/tmp/calibration.tar.gz), sample spool directories or directories of images to calibrate offline.")
+        self.parser.add_argument("--batch_output",type=str,default="batch_results",help="Directory where the ost.yaml and json result of every batch session is written. (default:batch_results)")
+        self.parser.add_argument("--batch_workers",type=int,default=0,help="Number of worker processes used to decode images and detect corners in batch mode, 0 uses all cores. (default:0)")
+        self.parser.add_argument("--camera_model",type=str,default="pinhole",choices=["pinhole","fisheye"],help="Camera model used for batch calibration. (default:pinhole)")
+        
+        #################### replay of recordings (replay.py) ############################
+        self.parser.add_argument("--replay_input",type=str,default=None,help="Video file, image directory or tar archive written by the calibrator, replayed in place of the camera.")
+        self.parser.add_argument("--replay_rate",type=str,default="native",help="Replay rate : native (the recording's frame rate), fast (as fast as the calibrator goes, without dropping frames) or a frame rate. (default:native)")
+        self.parser.add_argument("--replay_fps",type=float,default=30.0,help="Native frame rate of image directories and tar archives. (default:30)")
+        self.parser.add_argument("--replay_report",type=str,default=None,help="JSON file the replay statistics are written to.")
         
         #################### resolution of camera ############################
         self.cam_resolution = {
@@ -21,6 +71,6 @@ class Params:
             4 : (1920,1080)
         }
         
-        self.args = self.parser.parse_args()
+        self.args = self.parser.parse_args(argv)
         
         self.img_w , self.img_h = self.cam_resolution[self.args.resolution]
\ No newline at end of file
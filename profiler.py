@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import time
+import marshal
+import threading
+from collections import defaultdict
+
+from calib_logger import CalibLogger
+from metrics import METRICS
+
+
+class Profiler():
+    """
+    On-demand profiling of a live session, across the capture, consumer, encoder and Flask threads.
+    
+    A sampling thread walks the stacks of all the other threads (sys._current_frames) every interval and
+    accumulates them into cProfile-compatible statistics, written as a .prof file that pstats, snakeviz etc.
+    read. Meanwhile the METRICS stage timers record their spans, written as a Chrome trace-event JSON
+    (chrome://tracing, Perfetto) with one track per thread.
+    
+    Nothing runs and nothing is recorded while no session is active. Times are wall-clock : a thread blocked
+    on a queue or a socket accumulates time in the waiting function.
+    """
+    # longest session start() accepts, in seconds
+    MAX_SECONDS = 120.0
+    # shortest sampling interval, in seconds
+    MIN_INTERVAL = 0.001
+    
+    def __init__(self,out_dir = "/tmp/calibration_profiles"):
+        self.out_dir = out_dir
+        self.logger = CalibLogger().get_logger()
+        
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.result = None
+    
+    @property
+    def active(self):
+        return self._thread is not None
+    
+    def start(self,seconds,interval = 0.005):
+        """
+        Start profiling for the given number of seconds (at most MAX_SECONDS). Returns False if a session is
+        already running.
+        """
+        seconds = min(max(float(seconds),0.0),self.MAX_SECONDS)
+        interval = max(float(interval),self.MIN_INTERVAL)
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._stop.clear()
+            self.result = None
+            METRICS.trace = []
+            self._thread = threading.Thread(target = self._run,args = (seconds,interval),name = "profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        self.logger.info("########## profiling for %g s ##########" % seconds)
+        return True
+    
+    def start_from_env(self,variable = "CALIB_PROFILE"):
+        """
+        Profile the first $CALIB_PROFILE seconds of the process, if set.
+        """
+        seconds = float(os.environ.get(variable,0) or 0)
+        if seconds > 0:
+            self.start(seconds)
+    
+    def stop(self):
+        self._stop.set()
+    
+    def wait(self,timeout = None):
+        """
+        Wait for the running session to end and return its result (see _run).
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.result
+    
+    def _run(self,seconds,interval):
+        own = threading.get_ident()
+        # (filename,line,function) -> [call count,self time,cumulative time,{caller : [count,self,cumulative]}]
+        stats = defaultdict(lambda : [0,0.0,0.0,defaultdict(lambda : [0,0.0,0.0])])
+        samples = 0
+        start = time.perf_counter()
+        last = start
+        deadline = start + seconds
+        while not self._stop.is_set():
+            now = time.perf_counter()
+            if now >= deadline:
+                break
+            # every sample stands for the time since the previous one
+            weight = now - last
+            last = now
+            for (tid,frame) in sys._current_frames().items():
+                if tid == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename,code.co_firstlineno,code.co_name))
+                    frame = frame.f_back
+                self.add_sample(stats,stack,weight)
+            samples += 1
+            self._stop.wait(interval)
+        
+        trace = METRICS.trace
+        METRICS.trace = None
+        elapsed = time.perf_counter() - start
+        try:
+            self.result = self.dump(stats,trace,samples,elapsed)
+        finally:
+            with self._lock:
+                self._thread = None
+    
+    @staticmethod
+    def add_sample(stats,stack,weight):
+        """
+        Account for one stack sample, innermost frame first.
+        """
+        seen = set()
+        for (i,func) in enumerate(stack):
+            entry = stats[func]
+            if i == 0:
+                entry[1] += weight
+            # recursive functions count once per sample
+            if func in seen:
+                continue
+            seen.add(func)
+            entry[0] += 1
+            entry[2] += weight
+            if i + 1 < len(stack):
+                caller = entry[3][stack[i+1]]
+                caller[0] += 1
+                if i == 0:
+                    caller[1] += weight
+                caller[2] += weight
+    
+    def dump(self,stats,trace,samples,elapsed):
+        os.makedirs(self.out_dir,exist_ok = True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        prof_path = os.path.join(self.out_dir,"profile-%s.prof" % stamp)
+        trace_path = os.path.join(self.out_dir,"trace-%s.json" % stamp)
+        
+        # cProfile/pstats layout : func -> (primitive calls,calls,self time,cumulative time,callers)
+        pstats_dict = dict()
+        for (func,(n,tt,ct,callers)) in stats.items():
+            pstats_dict[func] = (n,n,tt,ct,{caller : tuple(c[0:1] * 2 + c[1:]) for (caller,c) in callers.items()})
+        with open(prof_path,"wb") as f:
+            marshal.dump(pstats_dict,f)
+        
+        with open(trace_path,"w") as f:
+            json.dump(self.chrome_trace(trace or []),f)
+        
+        self.logger.info("########## profile of %d samples over %.1f s saved as %s , trace of %d spans as %s ##########" % (samples,elapsed,prof_path,len(trace or []),trace_path))
+        return {"samples" : samples,"seconds" : round(elapsed,3),"profile" : prof_path,"trace" : trace_path}
+    
+    @staticmethod
+    def chrome_trace(spans):
+        """
+        Chrome trace-event JSON of the (stage,thread id,start,end) spans recorded by the METRICS timers.
+        """
+        pid = os.getpid()
+        names = {t.ident : t.name for t in threading.enumerate()}
+        events = []
+        for tid in set(span[1] for span in spans):
+            events.append({"name" : "thread_name","ph" : "M","pid" : pid,"tid" : tid,
+                           "args" : {"name" : names.get(tid,str(tid))}})
+        for (stage,tid,start,end) in spans:
+            events.append({"name" : stage,"cat" : "calibration","ph" : "X","pid" : pid,"tid" : tid,
+                           "ts" : start * 1e6,"dur" : (end - start) * 1e6})
+        return {"traceEvents" : events,"displayTimeUnit" : "ms"}
+
+
+# process wide profiler
+PROFILER = Profiler()
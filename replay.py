@@ -0,0 +1,6 @@
+from Replayer import *
+
+if __name__ == "__main__":
+    
+    ReplayObj = Replayer()
+    ReplayObj.run()
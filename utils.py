@@ -2,8 +2,13 @@ from enum import Enum
 import math
 import numpy
 import cv2
-from queue import Queue
+from queue import Queue , Full
+from collections import defaultdict
+import itertools
 import threading
+import time
+
+from metrics import METRICS
 
 # Supported camera models
 class CAMERA_MODEL(Enum):
@@ -13,6 +18,12 @@ class CAMERA_MODEL(Enum):
 class CalibrationException(Exception):
     pass
 
+class CalibrationCancelled(CalibrationException):
+    """
+    Raised inside a calibration job that has been cancelled or has timed out.
+    """
+    pass
+
 def lmin(seq1,seq2):
     """
     Pairwise minimum of two sequences.
@@ -91,7 +102,8 @@ def get_corners(img,board,refine = True , checkerboard_flags = 0):
         mono = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
     else:
         mono = img 
-    (ok,corners) = cv2.findChessboardCorners(mono , (board.n_cols,board.n_rows) , flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | checkerboard_flags)
+    with METRICS.timer("find_chessboard_corners"):
+        (ok,corners) = cv2.findChessboardCorners(mono , (board.n_cols,board.n_rows) , flags = cv2.CALIB_CB_ADAPTIVE_THRESH | cv2.CALIB_CB_NORMALIZE_IMAGE | checkerboard_flags)
     
     if not ok:
         return (ok,corners)
@@ -131,10 +143,182 @@ def get_corners(img,board,refine = True , checkerboard_flags = 0):
                 index = row*board.n_rows + col 
                 min_distance = min(min_distance,pdist(corners[index,0],corners[index+board.n_cols,0]))
         radius = int(math.ceil(math.ceil(min_distance * 0.5)))
-        cv2.cornerSubPix(mono,corners,(radius,radius),(-1,-1),(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,30,0.1))
+        with METRICS.timer("corner_subpix"):
+            cv2.cornerSubPix(mono,corners,(radius,radius),(-1,-1),(cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,30,0.1))
         
     return (ok,corners)
 
+def get_board_corners(img,boards,refine = True,checkerboard_flags = 0):
+    """
+    Check all boards. Return corners for first chessboard that it detects if given multiple size chessboards.
+    
+    Returns (ok,corners,board)
+    """
+    for b in boards:
+        (ok,corners) = get_corners(img,b,refine,checkerboard_flags)
+        
+        if ok:
+            return (ok,corners,b)
+    return (False,None,None)
+
+def display_size(size):
+    """
+    Size (width,height) of the approximately VGA display image (scrib) for an image of the given size.
+    """
+    (width,height) = size
+    scale = math.sqrt((width*height)/(640.*480.))
+    if scale > 1.0:
+        return (int(width/scale),int(height/scale))
+    return (width,height)
+
+def downsample_and_detect(img,boards,checkerboard_flags = 0):
+    """
+    Downsample the input image to approximately VGA resolution and detect the
+    calibration target corners in the full-size image.
+    
+    Module level so that it can also be run in a detection worker process.
+    
+    Returns (scrib,corners,downsampled_corners,board,(x_scale,y_scale))
+    """
+    return downsample_and_track(img,boards,checkerboard_flags)[0]
+
+def tracking_roi(last_corners,x_scale,y_scale,size):
+    """
+    Region (x_min,y_min,x_max,y_max) of the downsampled image around the previous detection where the
+    board is searched first. None if the region would not be much smaller than the image.
+    """
+    xs = last_corners[:,:,0] / x_scale
+    ys = last_corners[:,:,1] / y_scale
+    (x_min,x_max,y_min,y_max) = (xs.min(),xs.max(),ys.min(),ys.max())
+    # leave room for the motion of the board since the previous frame
+    pad = max(32.0,0.3 * max(x_max - x_min,y_max - y_min))
+    x_min = max(0,int(x_min - pad))
+    y_min = max(0,int(y_min - pad))
+    x_max = min(size[0],int(math.ceil(x_max + pad)))
+    y_max = min(size[1],int(math.ceil(y_max + pad)))
+    if (x_max - x_min) * (y_max - y_min) > 0.6 * size[0] * size[1]:
+        return None
+    return (x_min,y_min,x_max,y_max)
+
+def downsample_and_track(img,boards,checkerboard_flags = 0,last_corners = None,detect_area = 640*480):
+    """
+    downsample_and_detect, searching the board first around last_corners (the full-size corners of the
+    previous detection, if any), and in the whole downsampled image only when it is not found there.
+    
+    The board is detected in the image downsampled to about detect_area pixels, which may differ from the
+    display image (scrib), and always refined in the full-size image.
+    
+    Returns (detection,roi_hit,detect_time) : detection as returned by downsample_and_detect, roi_hit None when
+    no region was searched, else whether the board was found in it, and the time spent in detection.
+    """
+    height = img.shape[0]
+    width = img.shape[1]
+    scale = math.sqrt((width*height)/(640.*480.))
+    
+    if scale > 1.0:
+        with METRICS.timer("downsample"):
+            scrib = cv2.resize(img,display_size((width,height)))
+    else:
+        scrib = img 
+        
+    # Due to rounding, actual horizontal/vertical scaling may differ slightly
+    x_scale = float(width) / scrib.shape[1]
+    y_scale = float(height) / scrib.shape[0]
+    
+    start = time.perf_counter()
+    
+    # image the board is detected in
+    detect_scale = math.sqrt((width*height)/float(detect_area))
+    if detect_scale <= 1.0:
+        detect_img = img
+    elif abs(detect_scale - scale) < 0.01:
+        detect_img = scrib
+    else:
+        with METRICS.timer("downsample"):
+            detect_img = cv2.resize(img,(int(width/detect_scale),int(height/detect_scale)))
+    detect_x_scale = float(width) / detect_img.shape[1]
+    detect_y_scale = float(height) / detect_img.shape[0]
+    
+    roi = None
+    if last_corners is not None:
+        roi = tracking_roi(last_corners,detect_x_scale,detect_y_scale,(detect_img.shape[1],detect_img.shape[0]))
+        
+    # Detect checkerboard
+    ok = False
+    roi_hit = None
+    if roi is not None:
+        (x_min,y_min,x_max,y_max) = roi
+        (ok,detect_corners,board) = get_board_corners(detect_img[y_min:y_max,x_min:x_max],boards,True,checkerboard_flags)
+        if ok:
+            detect_corners[:,:,0] += x_min
+            detect_corners[:,:,1] += y_min
+        roi_hit = ok
+    if not ok:
+        (ok,detect_corners,board) = get_board_corners(detect_img,boards,True,checkerboard_flags)
+    
+    # scale corners back to full size image
+    corners = None 
+    downsampled_corners = None
+    if ok:
+        if detect_img is not img:
+            # Refine up-scaled corners in the original full-res image
+            corners_unrefined = detect_corners.copy()
+            corners_unrefined[:,:,0] *= detect_x_scale
+            corners_unrefined[:,:,1] *= detect_y_scale
+            radius = int(math.ceil(detect_scale))
+            if len(img.shape) == 3 and img.shape[2] == 3:
+                mono = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+            else:
+                mono = img 
+            with METRICS.timer("corner_subpix"):
+                cv2.cornerSubPix(mono,corners_unrefined,(radius,radius),(-1,-1),(cv2.TERM_CRITERIA_EPS+cv2.TERM_CRITERIA_MAX_ITER,30,0.1))
+            
+            corners = corners_unrefined
+        else:
+            corners = detect_corners
+            
+        # corners in the display image
+        if detect_img is scrib:
+            downsampled_corners = detect_corners
+        else:
+            downsampled_corners = corners.copy()
+            downsampled_corners[:,:,0] /= x_scale
+            downsampled_corners[:,:,1] /= y_scale
+    detect_time = time.perf_counter() - start
+    
+    return ((scrib,corners,downsampled_corners,board,(x_scale,y_scale)),roi_hit,detect_time)
+
+def get_corners_from_buffer(buf,boards,checkerboard_flags = 0):
+    """
+    Decode an encoded image (PNG/PGM/JPEG bytes) and find the chessboard corners in the full-size image.
+    Used by the offline calibration, possibly in a detection worker process.
+    
+    Returns (ok,corners,board,(width,height))
+    """
+    img = cv2.imdecode(numpy.frombuffer(buf,numpy.uint8),cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise CalibrationException("Could not decode image")
+    (ok,corners,board) = get_board_corners(img,boards,True,checkerboard_flags)
+    return (ok,corners,board,(img.shape[1],img.shape[0]))
+
+def get_corners_from_spool(path,index,boards,checkerboard_flags = 0):
+    """
+    Find the chessboard corners in a sample of a spool file (see SampleStore.SpoolSampleStore).
+    The spool is memory-mapped, so the image is never copied.
+    
+    Returns (ok,corners,board,(width,height))
+    """
+    img = numpy.load(path,mmap_mode = "r")[index]
+    (ok,corners,board) = get_board_corners(img,boards,True,checkerboard_flags)
+    return (ok,corners,board,(img.shape[1],img.shape[0]))
+
+def init_detection_worker():
+    """
+    Initializer of the detection worker processes. Every worker already runs on its own core,
+    so keep OpenCV from spawning its own thread pool in each of them.
+    """
+    cv2.setNumThreads(1)
+
 def get_dist_model(dist_params,cam_model):
     # select dist model
     if CAMERA_MODEL.PINHOLE == cam_model:
@@ -168,6 +352,106 @@ def image_from_archive(archive,name):
     imagefiledata.resize((1,imagefiledata.size))
     return cv2.imdecode(imagefiledata,cv2.IMREAD_COLOR)
 
+class SampleIndex():
+    """
+    Grid hash over the (X,Y,size,skew) parameters of the samples in the database.
+    Cells are as large as the largest search radius, so a query only has to look at the 3^4 cells around
+    the query point instead of scanning every sample.
+    """
+    _neighbours = list(itertools.product((-1,0,1),repeat = 4))
+    
+    def __init__(self,cell_size = 0.2):
+        self.cell_size = cell_size
+        self.cells = defaultdict(list)
+        self.count = 0
+        
+    def cell(self,params):
+        return tuple(int(math.floor(p / self.cell_size)) for p in params)
+    
+    def add(self,params):
+        self.cells[self.cell(params)].append(tuple(params))
+        self.count += 1
+        
+    def min_distance(self,params,radius):
+        """
+        Returns the smallest L1 distance between params and a stored sample if it is <= radius, None otherwise.
+        radius must not be larger than the cell size.
+        """
+        assert radius <= self.cell_size
+        (cx,cy,cs,ck) = self.cell(params)
+        best = None
+        for (dx,dy,ds,dk) in self._neighbours:
+            for p in self.cells.get((cx+dx,cy+dy,cs+ds,ck+dk),()):
+                d = sum([abs(a-b) for (a,b) in zip(params,p)])
+                if d <= radius and (best is None or d < best):
+                    best = d
+        return best
+    
+    
+class FrameGate():
+    """
+    Cheap tests run before the checkerboard detection, on a small copy of the frame, to skip the
+    detector for frames that cannot give a useful sample :
+    
+    static : (almost) identical to the last detected frame, so its detection still holds. Compared with the
+             last detected frame rather than the previous one, so that slow continuous motion adds up, and
+             detected again after max_static frames in a row anyway
+    blurry : variance of the Laplacian below min_sharpness
+    no_board : the fast checkerboard presence test fails for every board. Squares get too small to be found
+               at the size of the other tests, so it runs at the detection resolution. It is only needed
+               when the detector is not already run with CALIB_CB_FAST_CHECK, which does the same test.
+    """
+    GATE_AREA = 320*240
+    STATIC_SIZE = (80,60)
+    
+    def __init__(self,boards,min_sharpness = 15.0,static_threshold = 1.0,presence_test = True,max_static = 15):
+        self._boards = boards
+        self.min_sharpness = min_sharpness
+        self.static_threshold = static_threshold
+        self.presence_test = presence_test
+        self.max_static = max_static
+        # tiny image of the last frame that was detected, and the static frames since
+        self.last_tiny = None
+        self.static_run = 0
+        self.skipped = {"static" : 0,"blurry" : 0,"no_board" : 0}
+        self.passed = 0
+        
+    @staticmethod
+    def downscale(gray,area):
+        height = gray.shape[0]
+        width = gray.shape[1]
+        scale = math.sqrt((width*height)/float(area))
+        return cv2.resize(gray,(int(width/scale),int(height/scale))) if scale > 1.0 else gray
+        
+    def check(self,gray,detect_area = 640*480):
+        """
+        Returns the reason to skip the detection of this frame, None if it should be detected.
+        """
+        small = self.downscale(gray,self.GATE_AREA)
+        tiny = cv2.resize(small,self.STATIC_SIZE,interpolation = cv2.INTER_AREA)
+        
+        reason = None
+        if (self.last_tiny is not None and self.static_run < self.max_static
+                and cv2.absdiff(tiny,self.last_tiny).mean() < self.static_threshold):
+            reason = "static"
+        elif cv2.Laplacian(small,cv2.CV_16S).var() < self.min_sharpness:
+            reason = "blurry"
+        elif self.presence_test:
+            detect = self.downscale(gray,detect_area)
+            if not any(cv2.checkChessboard(detect,(b.n_cols,b.n_rows)) for b in self._boards):
+                reason = "no_board"
+            
+        if reason is None:
+            self.passed += 1
+            self.last_tiny = tiny
+            self.static_run = 0
+        else:
+            self.skipped[reason] += 1
+            if reason == "static":
+                self.static_run += 1
+        return reason
+    
+    
 class ImageDrawable():
     """
     Passed to CalibrationNode after image handled. Allows plotting of images
@@ -188,21 +472,103 @@ class BufferQueue(Queue):
     Slight modification of the standard Queue that discards the oldest item 
     when adding and item and the queue is full.
     """
+    def __init__(self,maxsize = 0,name = None,camera = None):
+        Queue.__init__(self,maxsize)
+        # number of items discarded because the consumer was too slow
+        self.dropped = 0
+        # queue and camera labels of the discarded frames counter in METRICS
+        self._dropped_counter = METRICS.counter("calib_queue_dropped_frames_total",name,camera) if name else None
+        
     def put(self,item,*args,**kwargs):
         with self.mutex:
             if self.maxsize > 0 and self._qsize() == self.maxsize:
+                # the new item takes over the unfinished task of the discarded one
                 self._get()
+                self.dropped += 1
+                if self._dropped_counter is not None:
+                    self._dropped_counter.inc()
+            else:
+                self.unfinished_tasks += 1
             self._put(item)
-            self.unfinished_tasks += 1
             self.not_empty.notify()
             
+    def put_wait(self,item):
+        """
+        The standard put, waiting for room instead of discarding, e.g. to replay recordings without losing frames.
+        """
+        Queue.put(self,item)
+            
+class ProgressChannel():
+    """
+    Latest state of a calibration session (a JSON-able dict), published only when it changes. Subscribers
+    block until a newer state than the last one they have seen is available.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.state = dict()
+        self.seq = 0
+        self._closed = False
+        
+    def publish(self,state):
+        with self._cond:
+            if state == self.state:
+                return
+            self.state = state
+            self.seq += 1
+            self._cond.notify_all()
+            
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            
+    def updates(self,timeout = 15.0):
+        """
+        Generator of the states, starting with the current one. Yields None when nothing changed for timeout
+        seconds (so that the caller can check its client is still there), ends when the channel is closed.
+        """
+        last = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda : self._closed or self.seq > last,timeout)
+                if self._closed:
+                    return
+                if self.seq == last:
+                    state = None
+                else:
+                    (state,last) = (self.state,self.seq)
+            yield state
+            
 class ConsumerThread(threading.Thread):
-    def __init__(self,queue,function):
+    # put on the queue by stop() to wake the consumer up
+    STOP = object()
+    
+    def __init__(self,queue,function,camera = None):
         threading.Thread.__init__(self)
         self.queue = queue
         self.function = function
+        # camera label of the stages timed by function
+        self.camera = camera
+        self._stopping = threading.Event()
+        
+    def stop(self):
+        """
+        End the thread after the item it is handling, join() it to wait for that.
+        """
+        self._stopping.set()
+        try:
+            self.queue.put(self.STOP,timeout = 1.0)
+        except Full:
+            # the consumer is busy with the items ahead, it sees _stopping after the next one
+            pass
             
     def run(self):
-        while True:
+        METRICS.bind_camera(self.camera)
+        while not self._stopping.is_set():
             m = self.queue.get()
-            self.function(m)
\ No newline at end of file
+            try:
+                if m is not self.STOP:
+                    self.function(m)
+            finally:
+                # lets the producer join() the queue
+                self.queue.task_done()
\ No newline at end of file